@@ -0,0 +1,291 @@
+"""Make the SMAP files of past weeks again, one window of time at a time.
+
+When the calibrations or QC rules change, the upload files of weeks that
+were already sent have to be made again. backfill splits a date range
+into windows (a week each by default). For every window it runs the tower
+and each CR216 logger through the same steps as
+process_smap_data_for_NASA.py: join, downscale to hourly, add the air
+temperature and write the SMAP files. Each file is named after the last
+day of its window, e.g. 2401005_20160110.txt for the week from 2016-01-04.
+
+    python backfill.py 2016-01-04 2016-02-01 --days 7 --workers 4
+
+Run it from the SMAP directory, like the pipeline. Only the records of
+its window are read from each logger file: the sparse index of the file
+(see toa5_index.py) gives the offset to start at, and reading stops at
+the end of the window. Every window and logger is a separate job. The
+jobs run in parallel (see parallel.py), each in its own work directory,
+and the files they make are moved to output_dir.
+
+Logger files with records out of order or repeated are sorted into the
+work directory first (see toa5_sort.py). The watermarks and the
+sixtyMinuteTable files of the pipeline are not touched.
+"""
+import argparse
+import os
+import shutil
+import sys
+
+import process_smap_data_for_NASA as pipeline
+from compression import COMPRESSIONS, open_file, plain_name
+from csi_time import epoch_date, epoch_day
+from downscalers import downscale_to_hourly
+from merge_join import merge_join, read_table, write_table
+from parallel import run_jobs
+from smap_basin_functions import make_smap_data_for_basin_sites
+from smap_tower_functions import make_smap_data_for_tower_sites
+from toa5_index import last_timestamp, read_range, update_index
+from toa5_sort import KEEP_POLICIES, sort_datafile
+
+# Where the SMAP files are written.
+BACKFILL_DIR = 'backfill'
+
+# Days in a window.
+WINDOW_DAYS = 7
+
+# The tower's branch; the CR216 branches are named after their sites.
+TOWER = 'tower'
+
+
+def windows(start, end, days=WINDOW_DAYS):
+    """Split the dates from start up to end into windows of days days.
+
+    param: start, end - 'YYYY-MM-DD' dates. end is not included, and the
+        last window stops there even if it is shorter.
+
+    Returns a list of (start, end) timestamps ('YYYY-MM-DD 00:00:00').
+    """
+    first = epoch_day(start)
+    last = epoch_day(end)
+    if last <= first:
+        raise ValueError("{0} is not after {1}".format(end, start))
+    if days < 1:
+        raise ValueError("Windows must be at least a day long")
+    return [
+        (epoch_date(day) + ' 00:00:00',
+         epoch_date(min(day + days, last)) + ' 00:00:00')
+        for day in range(first, last, days)]
+
+
+def window_date(window):
+    """Return the 'YYYYMMDD' date of the last day of a window."""
+    return epoch_date(epoch_day(window[1][:10]) - 1).replace('-', '')
+
+
+def sites():
+    """Return the names of every branch: the tower and the CR216 sites."""
+    return [TOWER] + [
+        pipeline.CR216_files[soil_file][2]
+        for soil_file in sorted(pipeline.CR216_files.keys())]
+
+
+def logger_files(site):
+    """Return the logger files a branch reads."""
+    if site == TOWER:
+        return [pipeline.soil_moisture_file, pipeline.upper_file,
+                pipeline.flux_data_file]
+    for soil_file, (_, _, this_site, _) in pipeline.CR216_files.items():
+        if this_site == site:
+            return [pipeline.find_file(pipeline.data_dir + '/' + soil_file),
+                    pipeline.flux_data_file]
+    raise ValueError("Unknown site: {0}".format(site))
+
+
+def prepare_sources(input_files, work_dir, keep='last'):
+    """Index the logger files, sorting those that need it.
+
+    Returns {logger file: (file to read, its index)}. A file with records
+    out of order or repeated is read from a sorted copy in work_dir.
+    """
+    sources = {}
+    for input_file in input_files:
+        source = input_file
+        index = update_index(input_file)
+        if index['unsorted']:
+            source = os.path.join(
+                work_dir, os.path.basename(plain_name(input_file)) +
+                '.sorted')
+            stats = sort_datafile(input_file, source, keep=keep)
+            pipeline.report_duplicates(input_file, stats)
+            index = update_index(source)
+        sources[input_file] = (source, index)
+    return sources
+
+
+def copy_window(source, window, output_file):
+    """Write the header and the records of a window of a logger file.
+
+    param: source - (file to read, its index) (see prepare_sources).
+
+    Returns the number of records written.
+    """
+    input_file, index = source
+    n_records = 0
+    with open_file(input_file, 'rb') as in_file:
+        header = [in_file.readline() for _ in range(index['header_lines'])]
+    with open(output_file, 'wb') as out_file:
+        out_file.writelines(header)
+        for line in read_range(input_file, index, *window):
+            out_file.write(line)
+            n_records += 1
+    return n_records
+
+
+def add_air_temperature(sixty_file, flux_file, smap_file):
+    """Add the air temperature to every hour (-8888 where it is missing)."""
+    write_table(
+        merge_join(
+            [read_table(sixty_file, header_lines=1),
+             read_table(flux_file, ['"TIMESTAMP"', '"t_hmp_Avg"'])],
+            how='left'),
+        smap_file)
+
+
+def backfill_window(site, sources, window, work_dir, output_dir,
+                    compression=None):
+    """Make the SMAP files of one branch for one window.
+
+    The work is done in work_dir, which is removed afterwards, and the
+    SMAP files are moved to output_dir. Returns their names there; none
+    if the loggers have no records in the window.
+    """
+    os.makedirs(work_dir)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        files = logger_files(site)
+        copies = [os.path.basename(plain_name(name)) for name in files]
+        n_records = [
+            copy_window(sources[name], window, copy)
+            for name, copy in zip(files, copies)]
+        if not n_records[0]:
+            return []
+        date = window_date(window)
+        if site == TOWER:
+            soil_moisture, upper, flux = copies
+            write_table(merge_join([
+                read_table(soil_moisture, pipeline.variables_to_keep(
+                    pipeline.get_vars(soil_moisture))),
+                read_table(upper, ['"TIMESTAMP"', '"rainfall_Tot"'])]),
+                'tenMinuteTable')
+            downscale_to_hourly(
+                'tenMinuteTable', 'sixtyMinuteTable',
+                pipeline.tenMinuteTable_sum_vars,
+                pipeline.tenMinuteTable_sample_vars, engine='stream')
+            add_air_temperature('sixtyMinuteTable', flux, 'smapdata')
+            if last_timestamp('smapdata', header_lines=1) is None:
+                return []
+            made = make_smap_data_for_tower_sites(
+                compression=compression, date=date)
+        else:
+            soil_file, flux = copies
+            sixty_file, smap_file, _, _ = pipeline.CR216_files[soil_file]
+            downscale_to_hourly(
+                soil_file, sixty_file, pipeline.CR216_sum_vars,
+                pipeline.CR216_sample_vars, engine='stream')
+            add_air_temperature(sixty_file, flux, smap_file)
+            made = make_smap_data_for_basin_sites(
+                site_names=[site], compression=compression, date=date)
+        written = []
+        for name in made:
+            written.append(os.path.join(output_dir, name))
+            os.rename(name, written[-1])
+        return written
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def backfill(start, end, days=WINDOW_DAYS, output_dir=BACKFILL_DIR,
+             workers=None, site_names=None, compression=None, keep='last'):
+    """Make the SMAP files of every window from start up to end.
+
+    param: start, end - 'YYYY-MM-DD' dates (end is not included).
+    param: days - Days in a window.
+    param: output_dir - Where to write the SMAP files.
+    param: workers - Number of jobs to run at once (see parallel.py).
+    param: site_names - Only make the files of these branches ('tower',
+        'Euphorbia', 'Open', 'River', 'Glade'). By default all of them.
+    param: compression - Write the SMAP files compressed ('gz', 'bz2' or
+        'xz'; see compression.py).
+    param: keep - Which of several records with the same timestamp to use
+        ('first' or 'last'; see toa5_sort.py).
+
+    Returns the names of the files written. Raises a RuntimeError once
+    every job has run if any of them failed.
+    """
+    site_names = site_names or sites()
+    output_dir = os.path.abspath(output_dir)
+    work_dir = os.path.join(output_dir, '.work')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        input_files = []
+        for site in site_names:
+            input_files.extend(
+                name for name in logger_files(site)
+                if name not in input_files)
+        sources = prepare_sources(input_files, work_dir, keep)
+        jobs = [
+            ('{0} {1}'.format(site, window_date(window)), backfill_window,
+             (site, sources, window,
+              os.path.join(work_dir, window_date(window), site),
+              output_dir, compression))
+            for window in windows(start, end, days)
+            for site in site_names]
+        results, errors = run_jobs(jobs, workers)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if errors:
+        raise RuntimeError("Could not backfill {0}:\n{1}".format(
+            ', '.join(name for name, _ in errors),
+            '\n'.join(error for _, error in errors)))
+    return sum([files for _, files in results], [])
+
+
+def main():
+    """Backfill from the command line."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('start', help='First day (YYYY-MM-DD).')
+    parser.add_argument(
+        'end', help='Day after the last one (YYYY-MM-DD, not included).')
+    parser.add_argument(
+        '--days', type=int, default=WINDOW_DAYS,
+        help='Days in a window (default: 7).')
+    parser.add_argument(
+        '--output-dir', default=BACKFILL_DIR,
+        help='Where to write the SMAP files (default: backfill).')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of windows to work on at once (default: SMAP_WORKERS '
+             'or the number of CPUs).')
+    parser.add_argument(
+        '--site', action='append', dest='site_names', choices=sites(),
+        help='Only make the files of this site. May be given more than '
+             'once (default: every site).')
+    parser.add_argument(
+        '--compress', choices=COMPRESSIONS, default=None,
+        help='Write the SMAP files compressed (default: plain text).')
+    parser.add_argument(
+        '--duplicates', choices=KEEP_POLICIES, default='last',
+        help='Which of several logger records with the same timestamp to '
+             'use (default: the last one appended).')
+    args = parser.parse_args()
+    try:
+        windows(args.start, args.end, args.days)
+    except ValueError as error:
+        parser.error(str(error))
+    try:
+        files = backfill(
+            args.start, args.end, args.days, args.output_dir, args.workers,
+            args.site_names, args.compress, args.duplicates)
+    except RuntimeError as error:
+        print error
+        sys.exit(1)
+    print "Wrote {0} files to {1}.".format(len(files), args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
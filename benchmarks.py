@@ -0,0 +1,243 @@
+"""Benchmark every stage of the pipeline on synthetic data.
+
+    python benchmarks.py --sizes 1 10 100 --engine dict
+
+For each size (in station-years) a record of that length is written with
+toa5_synth for the tower and for one CR216 logger. Then the stages of both
+branches are run one after another, each in a fresh process started in
+the SMAP directory, as process_smap_data_for_NASA.py runs them:
+
+    join tower, downscale tower, join tower air temperature, format tower,
+    downscale CR216, join CR216 air temperature, format CR216
+
+For every stage we report the data rows it read, the wall time, rows per
+second and the peak memory of its process (maximum resident set size,
+including the Python interpreter itself). The downscale stages always
+process the whole file (downscale_to_hourly), so that runs are comparable.
+
+Use --compress gz (or bz2, xz) to run the same stages on compressed copies
+of the logger files, writing the intermediate and SMAP files compressed as
+well (see compression.py), to compare with plain text. The size of each
+stage's input on disk is reported too.
+
+Use --json to keep the results, e.g. to compare before and after a change.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+
+from compression import COMPRESSIONS, compressed_name, open_file
+from toa5_synth import cr216_file, make_tower_data
+
+SIZES = [1, 10, 100]
+
+
+def count_rows(input_file, header_lines):
+    """Return the number of data lines in a file."""
+    rows = 0
+    with open_file(input_file, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(1 << 20), ''):
+            rows += block.count('\n')
+    return rows - header_lines
+
+
+def stages(engine, compression=None):
+    """Return the benchmarked stages.
+
+    Each is (name, input file, header lines, function); the function runs
+    the stage in the SMAP directory.
+
+    param: compression - The compression of the logger files, and of the
+        files the stages write (None for plain text).
+    """
+    soil_file = compressed_name('../' + cr216_file(0), compression)
+    ten_file = compressed_name('tenMinuteTable', compression)
+    tower_file = compressed_name('smapdata', compression)
+    basin_file = compressed_name('smapdata2', compression)
+
+    def join_tower():
+        import process_smap_data_for_NASA as pipeline
+        pipeline.join_tower(ten_file=ten_file)
+
+    def downscale_tower():
+        import process_smap_data_for_NASA as pipeline
+        from downscalers import downscale_to_hourly
+        downscale_to_hourly(
+            ten_file, 'sixtyMinuteTable',
+            pipeline.tenMinuteTable_sum_vars,
+            pipeline.tenMinuteTable_sample_vars, engine=engine)
+
+    def join_tower_air_temperature():
+        import process_smap_data_for_NASA as pipeline
+        pipeline.add_air_temperature('sixtyMinuteTable', tower_file)
+
+    def format_tower():
+        from smap_tower_functions import make_smap_data_for_tower_sites
+        make_smap_data_for_tower_sites(compression=compression)
+
+    def downscale_cr216():
+        import process_smap_data_for_NASA as pipeline
+        from downscalers import downscale_to_hourly
+        downscale_to_hourly(
+            soil_file, 'sixtyMinuteTable2', pipeline.CR216_sum_vars,
+            pipeline.CR216_sample_vars, engine=engine)
+
+    def join_cr216_air_temperature():
+        import process_smap_data_for_NASA as pipeline
+        pipeline.add_air_temperature('sixtyMinuteTable2', basin_file)
+
+    def format_cr216():
+        from smap_basin_functions import make_smap_data_for_basin_sites
+        make_smap_data_for_basin_sites(
+            site_names=['Euphorbia'], compression=compression)
+
+    return [
+        ('join tower',
+         compressed_name('../CR3000_SN9945_Table1.dat', compression), 4,
+         join_tower),
+        ('downscale tower', ten_file, 4, downscale_tower),
+        ('join tower air temperature', 'sixtyMinuteTable', 1,
+         join_tower_air_temperature),
+        ('format tower', tower_file, 1, format_tower),
+        ('downscale CR216', soil_file, 4, downscale_cr216),
+        ('join CR216 air temperature', 'sixtyMinuteTable2', 1,
+         join_cr216_air_temperature),
+        ('format CR216', basin_file, 1, format_cr216),
+    ]
+
+
+def compress_data(plain_dir, data_dir, compression):
+    """Write compressed copies of the logger files in plain_dir to data_dir."""
+    os.makedirs(os.path.join(data_dir, 'SMAP'))
+    for name in sorted(os.listdir(plain_dir)):
+        if not name.endswith('.dat'):
+            continue
+        output_file = compressed_name(
+            os.path.join(data_dir, name), compression)
+        with open(os.path.join(plain_dir, name), 'rb') as in_file, \
+                open_file(output_file, 'wb') as out_file:
+            shutil.copyfileobj(in_file, out_file, 1 << 20)
+
+
+def _measure(func, smap_dir, conn):
+    """Run func in smap_dir and send back (seconds, peak RSS in bytes)."""
+    os.chdir(smap_dir)
+    start = time.time()
+    func()
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on Linux.
+    conn.send((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+               * 1024))
+    conn.close()
+
+
+def run_stage(func, smap_dir):
+    """Run a stage in a fresh process. Returns (seconds, peak RSS bytes)."""
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=_measure, args=(func, smap_dir, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or process.exitcode:
+        raise RuntimeError("Stage failed (exit code {0})".format(
+            process.exitcode))
+    return result
+
+
+def benchmark(size, work_dir, engine='dict', compression=None):
+    """Benchmark every stage on size station-years of data.
+
+    Returns a list of dicts, one per stage.
+    """
+    data_dir = os.path.join(work_dir, '{0}'.format(size))
+    if not os.path.exists(os.path.join(data_dir, cr216_file(0))):
+        start = time.time()
+        make_tower_data(data_dir, years=size, stations=1)
+        print "Wrote {0} station-years of data in {1:.1f} s".format(
+            size, time.time() - start)
+    if compression is not None:
+        plain_dir = data_dir
+        data_dir = compressed_name(data_dir, compression)
+        if not os.path.exists(data_dir):
+            start = time.time()
+            compress_data(plain_dir, data_dir, compression)
+            print "Compressed the data ({0}) in {1:.1f} s".format(
+                compression, time.time() - start)
+    smap_dir = os.path.join(data_dir, 'SMAP')
+    results = []
+    for name, input_file, header_lines, func in stages(engine, compression):
+        seconds, peak = run_stage(func, smap_dir)
+        input_file = os.path.join(smap_dir, input_file)
+        rows = count_rows(input_file, header_lines)
+        results.append({
+            'stage': name,
+            'station_years': size,
+            'engine': engine,
+            'compression': compression,
+            'input_mb': os.path.getsize(input_file) / 2.0**20,
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds else None,
+            'peak_rss_mb': peak / 2.0**20,
+        })
+        print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    """Print one line of the results table."""
+    print "{station_years:>5} {stage:<28} {rows:>10} {input_mb:>9.1f} " \
+        "{seconds:>9.2f} {rows_per_second:>11.0f} {peak_rss_mb:>9.1f}".format(
+            **result)
+
+
+def main():
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=SIZES,
+        help='Station-years of data to benchmark (default: 1 10 100).')
+    parser.add_argument(
+        '--engine', default='dict',
+        choices=['dict', 'stream', 'numpy', 'parallel'],
+        help='Downscaler engine (default: dict).')
+    parser.add_argument(
+        '--compress', choices=COMPRESSIONS, default=None,
+        help='Run on compressed logger files and write compressed outputs '
+             '(default: plain text).')
+    parser.add_argument(
+        '--work-dir', default='benchmark_data',
+        help='Where to write the synthetic data (default: benchmark_data). '
+             'Data already there is reused.')
+    parser.add_argument(
+        '--json', help='Also write the results to this file.')
+    parser.add_argument(
+        '--clean', action='store_true',
+        help='Remove the synthetic data afterwards.')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    print "{0:>5} {1:<28} {2:>10} {3:>9} {4:>9} {5:>11} {6:>9}".format(
+        'st-yr', 'stage', 'rows', 'input MB', 'seconds', 'rows/s', 'peak MB')
+    results = []
+    for size in args.sizes:
+        results.extend(
+            benchmark(size, work_dir, args.engine, args.compress))
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+    if args.clean:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+"""Cache parsed logger data on disk, one .npy file per column.
+
+Parsing the text of the big datafiles is most of the work of a full
+reprocessing run, and the history in them never changes. The first time a
+column of a file is needed it is parsed and saved as a typed numpy array
+(timestamps as integer seconds since 1970, values as floats with NaN for
+"NAN"). After that, load_columns just loads the arrays.
+
+The loggers only ever append to their files, so an entry is keyed by the
+file's path and header, not by its size or modification time. It records
+how far into the file it has parsed, with a hash of the start of the data
+and the last line parsed. When the file has grown and both still match,
+only the lines appended since are parsed and added to the arrays. If they
+do not (the file was replaced or rewritten) the entry is made again from
+the start. Entries for an older header of the same file are dropped. The
+cache directory is kept under a size limit by removing the least recently
+used entries.
+
+    CACHE_DIR - where entries are kept (SMAP_CACHE_DIR, or .column_cache)
+    CACHE_LIMIT - maximum size in bytes (SMAP_CACHE_MB megabytes, or 1 GB)
+
+The pipeline reads the air temperature of the flux file through the cache
+(see hourly_table). Several processes may use the same entry at once; an
+entry is locked while it is brought up to date.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # without it (e.g. on Windows) entries are not locked
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy is needed to use the cache at all
+    np = None
+
+from compression import is_compressed, open_file
+from csi_time import format_hour, parse_csi_seconds
+from profiling import rows_read
+from toa5_reader import TOA5File
+from watermarks import header_hash
+
+CACHE_DIR = os.environ.get('SMAP_CACHE_DIR') or '.column_cache'
+CACHE_LIMIT = int(os.environ.get('SMAP_CACHE_MB') or 1024) * 2**20
+
+# Bytes at the start of the data whose hash is checked before an entry is
+# extended.
+PREFIX_BYTES = 1 << 16
+
+
+def parse_text(text, names, variables):
+    """Parse some columns of data lines.
+
+    param: text - The data lines, one string.
+    param: names - The variable names of the file.
+
+    Returns (timestamps, columns) as parse_text_columns does.
+    """
+    lines = text.replace('"NAN"', 'nan').splitlines()
+    columns = [names.index(var) for var in variables]
+    parts = [line.split(',', 1) for line in lines]
+    # A string dtype even without any lines, for parse_csi_seconds.
+    timestamps = np.array([part[0] for part in parts], dtype=str)
+    table = np.fromstring(
+        ','.join([part[1] for part in parts if len(part) > 1]), sep=',')
+    if table.size == len(lines) * (len(names) - 1):
+        table = table.reshape(len(lines), len(names) - 1)
+        values = dict(
+            (var, table[:, column - 1].copy())
+            for var, column in zip(variables, columns))
+    else:
+        rows = [line.split(',') for line in lines]
+        values = dict(
+            (var, np.array([float(row[column]) for row in rows]))
+            for var, column in zip(variables, columns))
+    return timestamps, values
+
+
+def parse_text_columns(input_file, variables, header_lines=4):
+    """Parse some columns of a datafile from text.
+
+    Returns (names, timestamps, columns): the variable names, the quoted
+    TIMESTAMP strings and a dict of variable -> float array with NaN for
+    "NAN". All numbers are parsed in one call to numpy when every field
+    is numeric; otherwise the requested columns are converted one at a
+    time, which raises the same errors as float() would.
+    """
+    with open_file(input_file, 'r') as in_file:
+        header = [in_file.readline() for _ in range(header_lines)]
+        text = in_file.read()
+    names = header[1 if header_lines == 4 else 0].rstrip().split(',')
+    timestamps, values = parse_text(text, names, variables)
+    return names, timestamps, values
+
+
+def fingerprint(input_file, header_lines=4):
+    """Return what identifies a datafile: its path and header.
+
+    The file may grow and keep the same fingerprint (see load_columns).
+    """
+    return {
+        'path': os.path.abspath(input_file),
+        'header': header_hash(input_file, header_lines),
+        'header_lines': header_lines,
+    }
+
+
+def _entry_size(entry):
+    """Return the number of bytes used by a cache entry."""
+    return sum(
+        os.path.getsize(os.path.join(entry, name))
+        for name in os.listdir(entry))
+
+
+def evict(cache_dir=CACHE_DIR, limit=CACHE_LIMIT, keep=None):
+    """Remove least recently used entries until the cache fits in limit.
+
+    param: keep - An entry that must not be removed (the one in use).
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        meta_file = os.path.join(entry, 'meta.json')
+        if os.path.exists(meta_file):
+            entries.append(
+                (os.path.getmtime(meta_file), entry, _entry_size(entry)))
+    total = sum(size for _, _, size in entries)
+    for _, entry, size in sorted(entries):
+        if total <= limit:
+            break
+        if entry != keep:
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def _drop_stale(cache_dir, path, keep):
+    """Remove the entries for older versions of the file at path."""
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        meta_file = os.path.join(entry, 'meta.json')
+        if entry == keep or not os.path.exists(meta_file):
+            continue
+        try:
+            with open(meta_file, 'r') as infile:
+                stale = json.load(infile)['fingerprint']['path'] == path
+        except (IOError, ValueError, KeyError):
+            continue  # Being written, or from an older version.
+        if stale:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def _lock(entry):
+    """Lock an entry against other processes. Returns the lock file."""
+    lock_file = open(os.path.join(entry, 'lock'), 'w')
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def _save(entry, name, data):
+    """Write a file of an entry, replacing the old one atomically."""
+    tmp_file = os.path.join(entry, name + '.tmp')
+    with open(tmp_file, 'wb') as outfile:
+        if name.endswith('.npy'):
+            np.save(outfile, data)
+        else:
+            json.dump(data, outfile)
+    os.rename(tmp_file, os.path.join(entry, name))
+
+
+def _parsed_until(input_file, meta):
+    """Return the offset the entry can be extended from, or None.
+
+    None means the file no longer starts with what was parsed, so the
+    entry has to be made again.
+    """
+    end = meta.get('end')
+    if end is None:
+        return None
+    if not is_compressed(input_file) and os.path.getsize(input_file) < end:
+        return None
+    data_start = meta['data_start']
+    with open_file(input_file, 'rb') as in_file:
+        in_file.seek(data_start)
+        prefix = in_file.read(min(PREFIX_BYTES, end - data_start))
+        if hashlib.sha1(prefix).hexdigest() != meta['prefix']:
+            return None
+        in_file.seek(end - len(meta['tail']))
+        if in_file.read(len(meta['tail'])) != meta['tail']:
+            return None
+    return end
+
+
+def _read_lines(input_file, offset):
+    """Return the complete lines of a file from offset, and where they end.
+
+    A last line without its line ending (the logger is still writing it)
+    is left for next time.
+    """
+    with open_file(input_file, 'rb') as in_file:
+        in_file.seek(offset)
+        text = in_file.read()
+    text = text[:text.rfind('\n') + 1]
+    return text, offset + len(text)
+
+
+def _update(input_file, entry, meta, variables, header_lines):
+    """Bring an entry up to date with the file, and add variables to it.
+
+    Returns the updated meta.
+    """
+    offset = _parsed_until(input_file, meta)
+    missing = [var for var in variables if var not in meta['columns']]
+    extend = offset is not None and not missing
+    if extend:
+        variables = sorted(meta['columns'])
+    else:
+        # Parse everything, for every column the entry has or needs.
+        variables = sorted(set(meta['columns']) | set(variables))
+        toa5 = TOA5File(input_file, header_lines)
+        toa5.close()
+        meta.update(names=toa5.names, data_start=toa5.data_start, rows=0)
+        offset = toa5.data_start
+    text, end = _read_lines(input_file, offset)
+    if extend and end == offset:
+        return meta  # Nothing new.
+    timestamps, values = parse_text(text, meta['names'], variables)
+    new = [('timestamp.npy', parse_csi_seconds(timestamps))] + [
+        ('{0}.npy'.format(meta['names'].index(var)), values[var])
+        for var in variables]
+    for name, data in new:
+        if extend:
+            data = np.concatenate([np.load(os.path.join(entry, name)), data])
+        _save(entry, name, data)
+    meta['columns'] = dict(
+        (var, name) for var, (name, _) in zip(variables, new[1:]))
+    meta['TIMESTAMP'] = 'timestamp.npy'
+    meta['rows'] += len(timestamps)
+    with open_file(input_file, 'rb') as in_file:
+        in_file.seek(meta['data_start'])
+        meta['prefix'] = hashlib.sha1(
+            in_file.read(min(PREFIX_BYTES, end - meta['data_start']))
+        ).hexdigest()
+    if text:
+        meta['tail'] = text[text.rstrip('\r\n').rfind('\n') + 1:]
+    elif not extend:
+        meta['tail'] = ''
+    meta['end'] = end
+    return meta
+
+
+def load_columns(input_file, variables, cache_dir=CACHE_DIR,
+                 limit=CACHE_LIMIT, header_lines=4):
+    """Return the timestamps and some columns of a datafile as arrays.
+
+    param: variables - Variable names (with their double quotes).
+
+    Returns (names, seconds, columns): the variable names in the file, the
+    timestamps as integer seconds since 1970 and a dict of variable ->
+    float array (NaN for "NAN"). Columns are read from the cache; records
+    appended since they were cached are parsed and added to it first. A
+    last line that is still being written is left out.
+    """
+    if np is None:
+        raise ImportError("The column cache requires numpy")
+    this_fingerprint = fingerprint(input_file, header_lines)
+    key = hashlib.sha1(
+        json.dumps(this_fingerprint, sort_keys=True)).hexdigest()
+    entry = os.path.join(cache_dir, key)
+    meta_file = os.path.join(entry, 'meta.json')
+    if not os.path.isdir(entry):
+        try:
+            os.makedirs(entry)
+        except OSError:
+            if not os.path.isdir(entry):
+                raise
+    lock_file = _lock(entry)
+    try:
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r') as infile:
+                meta = json.load(infile)
+            meta['names'] = [str(name) for name in meta['names']]
+            meta['tail'] = str(meta['tail'])
+        else:
+            _drop_stale(cache_dir, this_fingerprint['path'], entry)
+            meta = {'fingerprint': this_fingerprint, 'columns': {}}
+        meta = _update(input_file, entry, meta, variables, header_lines)
+        # Writing meta.json also marks the entry as recently used.
+        _save(entry, 'meta.json', meta)
+        seconds = np.load(os.path.join(entry, meta['TIMESTAMP']))
+        columns = dict(
+            (var, np.load(os.path.join(entry, meta['columns'][var])))
+            for var in variables)
+    finally:
+        lock_file.close()
+    evict(cache_dir, limit, keep=entry)
+    return meta['names'], seconds, columns
+
+
+def hourly_table(input_file, variables, cache_dir=CACHE_DIR,
+                 header_lines=4, keep=None, stats=None):
+    """Read the records at the top of every hour, through the cache.
+
+    param: variables - '"TIMESTAMP"' and the variables to keep, as for
+        merge_join.read_table.
+    param: keep - For a file with records out of order or repeated, sort
+        them and keep the 'first' or 'last' of each timestamp, as
+        toa5_sort.sorted_records does. None if the file is sorted.
+    param: stats - A dict that is filled in like sorted_records' (without
+        spill files, runs is always 0).
+
+    Returns a (header, rows) table like read_table's, with only the
+    records whose time is a whole hour: those are the only ones a join
+    with an hourly table can match. Values are written with repr, which
+    reads back as the same number, and NaN as "NAN".
+    """
+    if variables[0] != '"TIMESTAMP"':
+        raise ValueError("The first variable must be TIMESTAMP")
+    toa5 = TOA5File(input_file, header_lines)
+    toa5.close()
+    columns = toa5.columns(variables)
+    header = [
+        line if header_lines == 4 and i == 0 else [line[c] for c in columns]
+        for i, line in enumerate(toa5.header)]
+    names = [toa5.names[c] for c in columns[1:]]
+    _, seconds, values = load_columns(
+        input_file, names, cache_dir, header_lines=header_lines)
+    if keep is None:
+        order = np.arange(len(seconds))
+    elif keep == 'first':
+        order = np.unique(seconds, return_index=True)[1]
+    elif keep == 'last':
+        order = len(seconds) - 1 - np.unique(
+            seconds[::-1], return_index=True)[1]
+    else:
+        raise ValueError("Unknown keep policy: {0}".format(keep))
+    if stats is not None:
+        stats.update(
+            records=len(seconds),
+            unsorted=int(np.count_nonzero(np.diff(seconds) <= 0)),
+            duplicates=len(seconds) - len(order), runs=0)
+    top = order[seconds[order] % 3600 == 0]
+    rows_read(len(top))
+    hours = (seconds[top] // 3600).tolist()
+    texts = []
+    for var in names:
+        column = values[var][top]
+        text = map(repr, column.tolist())
+        for i in np.flatnonzero(np.isnan(column)).tolist():
+            text[i] = '"NAN"'
+        texts.append(text)
+
+    def rows():
+        for hour, fields in zip(hours, zip(*texts) if texts else
+                                [()] * len(hours)):
+            yield [format_hour(hour)] + list(fields)
+
+    return header, rows()
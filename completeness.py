@@ -0,0 +1,355 @@
+"""Keep track of which hours of a logger are complete, as it is downscaled.
+
+For every hour the downscaler writes we note how many records it was made
+from, and for each sample variable whether the hour has a top-of-hour
+value (a record at minute 0 that is not "NAN"). Without this, an hour with
+a missing sample only shows up as -7777, and finding out which hours are
+incomplete means reading the 10-minute data again.
+
+The counts and the sample bitmaps (one bit per hour and variable) are kept
+next to the downscaled file, in <output_file>.completeness (JSON, with the
+arrays zlib-compressed and base64-encoded; ten years of a logger take a
+few kB). downscale_incremental updates it as it goes (see downscalers.py).
+It can then be asked about any range of hours without reading the data:
+
+    completeness = load_completeness('sixtyMinuteTable2.completeness')
+    incomplete_hours(completeness, '2016-03-01', '2016-04-01')
+    gaps(completeness, '2016-03-01', '2016-04-01')
+    missing_samples(completeness, '"VW_20cm_Avg"', '2016-03-01')
+
+or from the command line:
+
+    python completeness.py sixtyMinuteTable2 --start 2016-03-01 --gaps
+
+Hours are whole hours since 1970 (see csi_time.py). Query results are
+quoted CSI timestamps of the start of each hour.
+"""
+import argparse
+import base64
+import json
+import os
+import zlib
+
+from csi_time import format_hour, parse_hour
+
+COMPLETENESS_SUFFIX = '.completeness'
+
+# Most records counted in an hour (they are kept in one byte).
+MAX_RECORDS = 255
+
+
+def completeness_file(output_file):
+    """Return the name of the completeness file of a downscaled file."""
+    return output_file + COMPLETENESS_SUFFIX
+
+
+def new_completeness(sample_vars, interval):
+    """Return an empty completeness record.
+
+    param: sample_vars - The variables whose top-of-hour samples are
+        tracked.
+    param: interval - Minutes between records, so that 60 / interval
+        records make a complete hour.
+    """
+    return {
+        'variables': list(sample_vars),
+        'interval': interval,
+        'first_hour': None,
+        'records': bytearray(),
+        'samples': [bytearray() for _ in sample_vars],
+    }
+
+
+def _set_bit(bits, i, value):
+    """Set bit i of a bitmap, growing it if needed."""
+    while len(bits) <= i >> 3:
+        bits.append(0)
+    if value:
+        bits[i >> 3] |= 1 << (i & 7)
+    else:
+        bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+
+
+def _bit(bits, i):
+    """Return bit i of a bitmap (False past its end)."""
+    if i >> 3 >= len(bits):
+        return False
+    return bool(bits[i >> 3] & (1 << (i & 7)))
+
+
+def _truncate_bits(bits, n):
+    """Keep only the first n bits of a bitmap."""
+    del bits[(n + 7) >> 3:]
+    if n & 7:
+        bits[-1] &= (1 << (n & 7)) - 1
+
+
+def record_hour(completeness, hour, n_records, samples):
+    """Note the records and samples of an hour.
+
+    param: hour - Hours since 1970.
+    param: samples - For each tracked variable, whether the hour has its
+        top-of-hour sample.
+
+    Hours must come in time order. An hour that was recorded before is
+    replaced, along with every hour after it (as downscale_incremental
+    rewrites the last hour it wrote), and hours skipped over have no
+    records.
+    """
+    if completeness['first_hour'] is None:
+        completeness['first_hour'] = hour
+    i = hour - completeness['first_hour']
+    if i < 0:
+        raise ValueError("Hour {0} is before the first hour, {1}".format(
+            format_hour(hour), format_hour(completeness['first_hour'])))
+    records = completeness['records']
+    del records[i:]
+    records.extend(bytearray(i - len(records)))
+    records.append(min(n_records, MAX_RECORDS))
+    for bits, present in zip(completeness['samples'], samples):
+        _truncate_bits(bits, i)
+        _set_bit(bits, i, present)
+
+
+def _samples_present(values, last_minute, n_samples):
+    """Return which samples of an hour the downscaler writes.
+
+    param: values - The values at minute 0, or None if there is no record
+        at minute 0.
+    param: last_minute - The minute of the hour's last record.
+
+    Like the downscaler (see downscalers.hourly_rows), a sample of 0 only
+    survives if no record comes after it in the hour; otherwise it is
+    reset to -7777.
+    """
+    if values is None:
+        return [False] * n_samples
+    return [
+        value != -7777 and (value != 0 or last_minute == 0)
+        for value in values]
+
+
+def track_hours(records, completeness, sample_cols):
+    """Pass (hour, minute, fields) records through, noting every hour.
+
+    param: sample_cols - The columns of the tracked variables. A sample is
+        missing if it is -7777 in the downscaled file: there is no record
+        at minute 0, its value is -7777 (a "NAN"; see
+        downscalers.parse_record), or it is 0 and was reset.
+
+    Each hour is recorded once its last record has been passed on.
+    """
+    n_samples = len(sample_cols)
+    this_hour = None
+    for record in records:
+        if record[0] != this_hour:
+            if this_hour is not None:
+                record_hour(completeness, this_hour, n_records,
+                            _samples_present(values, minute, n_samples))
+            this_hour = record[0]
+            n_records = 0
+            values = None
+        n_records += 1
+        minute = record[1]
+        if minute == 0:
+            values = [float(record[2][c]) for c in sample_cols]
+        yield record
+    if this_hour is not None:
+        record_hour(completeness, this_hour, n_records,
+                    _samples_present(values, minute, n_samples))
+
+
+def _pack(data):
+    """Return a bytearray as compressed, base64 encoded text."""
+    return base64.b64encode(zlib.compress(str(data)))
+
+
+def _unpack(text):
+    """Return the bytearray packed by _pack."""
+    return bytearray(zlib.decompress(base64.b64decode(text)))
+
+
+def save_completeness(completeness, file_name):
+    """Write a completeness record, replacing the old one atomically."""
+    saved = dict(completeness)
+    saved['records'] = _pack(completeness['records'])
+    saved['samples'] = [_pack(bits) for bits in completeness['samples']]
+    tmp_file = file_name + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(saved, outfile)
+    os.rename(tmp_file, file_name)
+
+
+def load_completeness(file_name):
+    """Load a completeness record, or return None if there is none."""
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'r') as infile:
+        completeness = json.load(infile)
+    completeness['variables'] = [
+        str(var) for var in completeness['variables']]
+    completeness['records'] = _unpack(completeness['records'])
+    completeness['samples'] = [
+        _unpack(bits) for bits in completeness['samples']]
+    return completeness
+
+
+def expected_records(completeness):
+    """Return the number of records in a complete hour."""
+    return 60 // completeness['interval']
+
+
+def _hour(timestamp):
+    """Return the hours since 1970 of a CSI timestamp or 'YYYY-MM-DD'."""
+    timestamp = timestamp.strip('"')
+    if len(timestamp) == 10:
+        timestamp += ' 00:00:00'
+    return parse_hour(timestamp)[0]
+
+
+def _hours(completeness, start, end):
+    """Return the indexes of the hours from start up to end.
+
+    start and end default to the first and last hours recorded. Hours
+    outside those have no records.
+    """
+    first = completeness['first_hour']
+    if first is None:
+        return []
+    if start is None:
+        start = 0
+    else:
+        start = _hour(start) - first
+    if end is None:
+        end = len(completeness['records'])
+    else:
+        end = _hour(end) - first
+    return range(start, end)
+
+
+def _n_records(completeness, i):
+    """Return the records of the hour at index i (0 outside the record)."""
+    if 0 <= i < len(completeness['records']):
+        return completeness['records'][i]
+    return 0
+
+
+def incomplete_hours(completeness, start=None, end=None):
+    """Return the hours from start up to end with fewer records than
+    expected (including hours without any).
+
+    param: start, end - CSI timestamps or 'YYYY-MM-DD' dates; end is not
+        included. By default the first and last hours recorded.
+    """
+    expected = expected_records(completeness)
+    first = completeness['first_hour']
+    return [
+        format_hour(first + i) for i in _hours(completeness, start, end)
+        if _n_records(completeness, i) < expected]
+
+
+def gaps(completeness, start=None, end=None):
+    """Return the runs of hours without any records, from start up to end.
+
+    Returns a list of (first hour, hour after the last) pairs.
+    """
+    first = completeness['first_hour']
+    runs = []
+    gap_start = None
+    hours = _hours(completeness, start, end)
+    for i in hours:
+        if _n_records(completeness, i):
+            if gap_start is not None:
+                runs.append((format_hour(first + gap_start),
+                             format_hour(first + i)))
+                gap_start = None
+        elif gap_start is None:
+            gap_start = i
+    if gap_start is not None:
+        runs.append((format_hour(first + gap_start),
+                     format_hour(first + hours[-1] + 1)))
+    return runs
+
+
+def missing_samples(completeness, variable, start=None, end=None):
+    """Return the hours from start up to end without a top-of-hour sample
+    of variable (with its double quotes, e.g. '"VW_20cm_Avg"').
+    """
+    bits = completeness['samples'][completeness['variables'].index(variable)]
+    first = completeness['first_hour']
+    return [
+        format_hour(first + i) for i in _hours(completeness, start, end)
+        if not (0 <= i < len(completeness['records']) and _bit(bits, i))]
+
+
+def summary(completeness, start=None, end=None):
+    """Return counts of the hours from start up to end.
+
+    A dict of hours, complete (as many records as expected), incomplete
+    (some records), empty (none) and, for every tracked variable, the
+    hours without its sample (missing_samples).
+    """
+    expected = expected_records(completeness)
+    counts = {'hours': 0, 'complete': 0, 'incomplete': 0, 'empty': 0}
+    for i in _hours(completeness, start, end):
+        n_records = _n_records(completeness, i)
+        counts['hours'] += 1
+        if n_records >= expected:
+            counts['complete'] += 1
+        elif n_records:
+            counts['incomplete'] += 1
+        else:
+            counts['empty'] += 1
+    counts['missing_samples'] = dict(
+        (var, len(missing_samples(completeness, var, start, end)))
+        for var in completeness['variables'])
+    return counts
+
+
+def main():
+    """Answer questions about a downscaled file's hours."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'output_file', help='The downscaled file (e.g. sixtyMinuteTable2).')
+    parser.add_argument(
+        '--start', help='First hour or day (default: the first recorded).')
+    parser.add_argument(
+        '--end', help='Hour or day to stop at, not included (default: '
+                      'after the last recorded).')
+    parser.add_argument(
+        '--incomplete', action='store_true',
+        help='List the hours with fewer records than expected.')
+    parser.add_argument(
+        '--gaps', action='store_true',
+        help='List the runs of hours without any records.')
+    parser.add_argument(
+        '--missing', metavar='VARIABLE',
+        help='List the hours without a top-of-hour sample of VARIABLE '
+             '(e.g. VW_20cm_Avg).')
+    args = parser.parse_args()
+
+    completeness = load_completeness(completeness_file(args.output_file))
+    if completeness is None:
+        parser.error("{0} has no completeness file; it is made when the "
+                     "file is downscaled".format(args.output_file))
+    if args.incomplete:
+        for hour in incomplete_hours(completeness, args.start, args.end):
+            print hour
+    elif args.gaps:
+        for gap_start, gap_end in gaps(completeness, args.start, args.end):
+            print "{0},{1}".format(gap_start, gap_end)
+    elif args.missing:
+        for hour in missing_samples(
+                completeness, '"{0}"'.format(args.missing.strip('"')),
+                args.start, args.end):
+            print hour
+    else:
+        print json.dumps(
+            summary(completeness, args.start, args.end), indent=1,
+            sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Read and write gzip, bzip2 and xz compressed files like plain ones.
+
+Older logger files are archived compressed, and the outputs can be
+written compressed too. Which compression a file has is told by its name:
+
+    .gz - gzip
+    .bz2 - bzip2
+    .xz - xz (needs the lzma module: backports.lzma on Python 2)
+
+open_file opens any of them, or a plain file, and returns a file object
+with readline, iteration, seek and tell, so the readers do not have to
+know the difference. Seeking in a compressed file means decompressing
+everything before that point, and it cannot be memory mapped, so readers
+that jump around a file (toa5_index, toa5_reader, the watermarks) still
+work but read it from the start.
+
+    with open_file('CR216_SN22028_soil.dat.gz') as in_file:
+        for line in in_file:
+            ...
+
+find_file picks up a logger file that has been archived: if
+CR216_SN22028_soil.dat is not there but CR216_SN22028_soil.dat.gz is,
+that is the one used.
+"""
+import bz2
+import gzip
+import io
+import os
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:  # lzma is only needed for .xz files
+        lzma = None
+
+# The compressions we know, by file name extension.
+COMPRESSIONS = ('gz', 'bz2', 'xz')
+
+# gzip level to write with: that of the gzip command. Python's default, 9,
+# is several times slower for files only a few percent smaller.
+GZIP_LEVEL = 6
+
+# Bytes buffered on top of the (slow, pure Python) gzip and xz file objects.
+BUFFER_SIZE = 1 << 16
+
+
+def compression_of(name):
+    """Return the compression of a file ('gz', 'bz2', 'xz'), or None."""
+    extension = os.path.splitext(name)[1][1:]
+    if extension in COMPRESSIONS:
+        return extension
+    return None
+
+
+def is_compressed(name):
+    """Return True if a file name is that of a compressed file."""
+    return compression_of(name) is not None
+
+
+def compressed_name(name, compression=None):
+    """Return the name of a file with the extension of a compression.
+
+    param: compression - 'gz', 'bz2', 'xz', or None for a plain file.
+    """
+    if compression is None:
+        return name
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression: {0}".format(compression))
+    return name + '.' + compression
+
+
+def plain_name(name):
+    """Return the name of a file without its compression extension."""
+    if is_compressed(name):
+        return os.path.splitext(name)[0]
+    return name
+
+
+def find_file(name):
+    """Return name, or the name of its compressed archive if only that exists.
+
+    If neither exists name is returned as it is.
+    """
+    if os.path.exists(name):
+        return name
+    for compression in COMPRESSIONS:
+        if os.path.exists(compressed_name(name, compression)):
+            return compressed_name(name, compression)
+    return name
+
+
+def open_file(name, mode='rb', compression=None):
+    """Open a plain or compressed file.
+
+    param: mode - 'r', 'rb', 'w' or 'wb' (compressed files are always
+        binary; CSI files are read the same way either way).
+    param: compression - 'gz', 'bz2' or 'xz'. By default it is told from
+        name, so name can be a temporary file name when it is given.
+    """
+    compression = compression or compression_of(name)
+    if compression is None:
+        return open(name, mode)
+    mode = mode[:1]
+    if mode not in 'rw':
+        raise ValueError(
+            "Compressed files can only be read or written: {0}".format(name))
+    if compression == 'gz':
+        raw = gzip.GzipFile(name, mode + 'b', GZIP_LEVEL)
+    elif compression == 'bz2':
+        # BZ2File is written in C and does its own buffering.
+        return bz2.BZ2File(name, mode, BUFFER_SIZE)
+    elif compression == 'xz':
+        if lzma is None:
+            raise ImportError("Reading or writing {0} requires lzma "
+                              "(backports.lzma on Python 2)".format(name))
+        raw = lzma.LZMAFile(name, mode + 'b')
+    else:
+        raise ValueError("Unknown compression: {0}".format(compression))
+    if mode == 'r':
+        return io.BufferedReader(raw, BUFFER_SIZE)
+    return io.BufferedWriter(raw, BUFFER_SIZE)
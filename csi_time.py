@@ -0,0 +1,147 @@
+"""Parse and format CSI timestamps without datetime.strptime.
+
+CSI timestamps are always the same width, "YYYY-MM-DD HH:MM:SS" in double
+quotes, so the hour and minute can be sliced straight out of the string.
+The date part repeats for a whole day of records, so the number of days
+since 1970 is worked out once per date and remembered. Times are handled
+as whole minutes or hours since 1970-01-01 00:00, which are plain ints:
+they sort in time order and make cheap dict keys. Going back the other
+way, each day's date string is also made once and remembered.
+
+    minutes = parse_minutes('"2016-01-21 13:50:00"')
+    hour, minute = parse_hour('"2016-01-21 13:50:00"')
+    format_hour(hour)  # '"2016-01-21 13:00:00"'
+
+parse_csi_seconds does the same for a whole numpy array of timestamps.
+"""
+from datetime import date, datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for parse_csi_seconds
+    np = None
+
+# This is the universal CSI timestamp string width (with quotes).
+CSI_TIMESTAMP_WIDTH = len('"YYYY-MM-DD HH:MM:SS"')
+
+EPOCH = date(1970, 1, 1)
+_EPOCH_ORDINAL = EPOCH.toordinal()
+
+# 'YYYY-MM-DD' -> days since 1970, and back.
+_days = {}
+_dates = {}
+
+_TWO_DIGITS = ['{0:02d}'.format(i) for i in range(60)]
+
+
+def epoch_day(day):
+    """Return the days since 1970-01-01 of a 'YYYY-MM-DD' date."""
+    try:
+        return _days[day]
+    except KeyError:
+        # The first time a date is seen it is checked properly.
+        if len(day) != 10:
+            raise ValueError("Not a CSI date: {0!r}".format(day))
+        days = datetime.strptime(day, '%Y-%m-%d').toordinal() - \
+            _EPOCH_ORDINAL
+        _days[day] = days
+        _dates[days] = day
+        return days
+
+
+def epoch_date(days):
+    """Return the 'YYYY-MM-DD' date of a number of days since 1970-01-01."""
+    try:
+        return _dates[days]
+    except KeyError:
+        day = (EPOCH + timedelta(days=days)).isoformat()
+        _dates[days] = day
+        _days[day] = days
+        return day
+
+
+def _unquote(timestamp):
+    """Return a CSI timestamp without its quotes, checking its shape."""
+    if timestamp[:1] == '"':
+        timestamp = timestamp[1:-1]
+    if len(timestamp) != 19 or timestamp[10] != ' ' or \
+            timestamp[13] != ':' or timestamp[16] != ':':
+        raise ValueError("Not a CSI timestamp: {0!r}".format(timestamp))
+    return timestamp
+
+
+def parse_hour(timestamp):
+    """Return (hours since 1970, minute) of a CSI timestamp.
+
+    The timestamp may be given with or without its double quotes.
+    """
+    timestamp = _unquote(timestamp)
+    hour = int(timestamp[11:13])
+    minute = int(timestamp[14:16])
+    if hour > 23 or minute > 59:
+        raise ValueError("Not a CSI timestamp: {0!r}".format(timestamp))
+    return epoch_day(timestamp[:10]) * 24 + hour, minute
+
+
+def parse_minutes(timestamp):
+    """Return the minutes since 1970 of a CSI timestamp."""
+    hours, minute = parse_hour(timestamp)
+    return hours * 60 + minute
+
+
+def format_hour(hours):
+    """Return the quoted CSI timestamp of the start of an hour since 1970."""
+    day, hour = divmod(hours, 24)
+    return '"' + epoch_date(day) + ' ' + _TWO_DIGITS[hour] + ':00:00"'
+
+
+def format_minutes(minutes):
+    """Return the quoted CSI timestamp of a minute since 1970."""
+    hours, minute = divmod(minutes, 60)
+    day, hour = divmod(hours, 24)
+    return '"' + epoch_date(day) + ' ' + _TWO_DIGITS[hour] + ':' + \
+        _TWO_DIGITS[minute] + ':00"'
+
+
+def compact_date(timestamp):
+    """Return the 'YYYYMMDD' date of a CSI timestamp (used in file names)."""
+    timestamp = _unquote(timestamp)
+    return timestamp[:4] + timestamp[5:7] + timestamp[8:10]
+
+
+def _days_from_civil(year, month, day):
+    """Return days since 1970-01-01 for arrays of proleptic Gregorian dates."""
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def parse_csi_seconds(timestamps):
+    """Return seconds since 1970-01-01 for an array of quoted CSI timestamps.
+
+    The digits are picked out of the fixed-width strings directly, so no
+    datetime objects are made.
+    """
+    if np is None:
+        raise ImportError("parse_csi_seconds requires numpy")
+    width = CSI_TIMESTAMP_WIDTH
+    timestamps = np.asarray(timestamps)
+    if (np.char.str_len(timestamps) != width).any():
+        raise ValueError("Timestamps are not quoted CSI timestamps")
+    digits = np.frombuffer(
+        timestamps.astype('S%d' % width).tobytes(),
+        dtype=np.uint8).reshape(-1, width)
+    digits = digits.astype(np.int64) - ord('0')
+
+    def number(start, stop):
+        value = np.zeros(len(digits), dtype=np.int64)
+        for i in range(start, stop):
+            value = value * 10 + digits[:, i]
+        return value
+
+    days = _days_from_civil(number(1, 5), number(6, 8), number(9, 11))
+    return ((days * 24 + number(12, 14)) * 60 + number(15, 17)) * 60 + \
+        number(18, 20)
@@ -0,0 +1,363 @@
+"""Upload files to NASA's ftp server over a small pool of connections.
+
+The uplink from the field station is slow and drops out, so:
+
+ - What is already on the server comes from a single directory listing
+   (MLSD, or NLST if the server has no MLSD) rather than one SIZE call
+   per file.
+ - A local manifest (UPLOAD_MANIFEST) records the hash, size and remote
+   name of every file we have sent, so unchanged files are skipped and
+   changed ones (e.g. reprocessed weeks) are noticed. The hash leaves out
+   the time a SMAP file was written (its banner row), and a compressed
+   file is hashed decompressed, so a file made again with the same data
+   is not sent again.
+ - Several files are sent at once, each worker thread over its own
+   connection (FTP_CONNECTIONS).
+ - Binary transfers use a large block size (BLOCK_SIZE).
+ - A binary file that is already partly on the server is resumed from
+   where it stopped (REST) instead of being sent again.
+ - Failed transfers, and a failed first connection for the listing, are
+   retried, reconnecting each time and waiting twice as long after every
+   failure (RETRIES, RETRY_DELAY).
+
+What happens to a file that changed since it was sent depends on the
+policy: 'skip' leaves the old copy alone (the old behaviour), 'overwrite'
+replaces it, and 'version' sends it under a new name (2401001_20160121_v2.txt).
+
+Text files (.txt, .htm, .html) are still sent in ASCII mode with
+storlines, as before, so the server keeps converting their line endings.
+ASCII transfers cannot be resumed by offset, so they are sent again in
+full when retried. Compressed files (.txt.gz and so on) are binary.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from ftplib import FTP, all_errors, error_perm
+from Queue import Queue, Empty
+
+from compression import open_file, plain_name
+
+HOST = 'enso.princeton.edu'
+REMOTE_DIR = 'incoming/Caylor_smap/'
+FTP_CONNECTIONS = 3
+BLOCK_SIZE = 64 * 1024
+RETRIES = 4
+RETRY_DELAY = 5
+TEXT_EXTENSIONS = (".txt", ".htm", ".html")
+UPLOAD_MANIFEST = 'upload_manifest.json'
+POLICIES = ('skip', 'overwrite', 'version')
+
+# The time at the end of the banner row of a SMAP file (see
+# smap_writer.banner), which is one of its first HEADER_ROWS rows.
+BANNER_TIME = re.compile(
+    r',"?[A-Z][a-z]{2}, \d{2} [A-Z][a-z]{2} \d{4} \d{2}:\d{2} GMT"?\r?\n?$')
+HEADER_ROWS = 3
+
+
+def connect(host=HOST, remote_dir=REMOTE_DIR, port=21, user='', passwd='',
+            timeout=60):
+    """Open an (anonymous by default) ftp session in remote_dir."""
+    ftp = FTP()
+    ftp.connect(host, port, timeout)
+    ftp.login(user, passwd)
+    ftp.cwd(remote_dir)
+    return ftp
+
+
+def remote_size(ftp, remote_name):
+    """Return the size of a file on the server, or None if it is not there."""
+    try:
+        ftp.voidcmd('TYPE I')  # Many servers only answer SIZE in binary.
+        return ftp.size(remote_name)
+    except error_perm:
+        return None
+
+
+def remote_listing(ftp):
+    """Return a dict of name -> size for the files in the current directory.
+
+    Uses one MLSD listing. Servers without MLSD get one NLST listing
+    instead, which has no sizes (they are None).
+    """
+    lines = []
+    try:
+        ftp.retrlines('MLSD', lines.append)
+    except error_perm:
+        return dict((os.path.basename(name), None) for name in ftp.nlst())
+    listing = {}
+    for line in lines:
+        facts, _, name = line.partition(' ')
+        facts = dict(
+            fact.split('=', 1) for fact in facts.split(';') if '=' in fact)
+        if facts.get('type', 'file').lower() == 'file':
+            size = facts.get('size')
+            listing[name] = int(size) if size is not None else None
+    return listing
+
+
+def file_hash(local_file):
+    """Return the sha1 of a file's contents, without the banner's time.
+
+    A compressed file is hashed decompressed, since gzip also records
+    when the file was written.
+    """
+    digest = hashlib.sha1()
+    with open_file(local_file, 'rb') as infile:
+        for _ in range(HEADER_ROWS):
+            digest.update(BANNER_TIME.sub('', infile.readline()))
+        for block in iter(lambda: infile.read(BLOCK_SIZE), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_file=UPLOAD_MANIFEST):
+    """Load the upload manifest, or return an empty one if there is none."""
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as infile:
+        return json.load(infile)
+
+
+def save_manifest(manifest, manifest_file=UPLOAD_MANIFEST):
+    """Write the upload manifest, replacing the old one atomically."""
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.rename(tmp_file, manifest_file)
+
+
+def versioned_name(remote_name, listing):
+    """Return the first name_vN.ext (N >= 2) that is not in listing.
+
+    A compression extension stays with the one before it
+    (2401001_20160121_v2.txt.gz).
+    """
+    root, ext = os.path.splitext(plain_name(remote_name))
+    ext += remote_name[len(plain_name(remote_name)):]
+    version = 2
+    while '{0}_v{1}{2}'.format(root, version, ext) in listing:
+        version += 1
+    return '{0}_v{1}{2}'.format(root, version, ext)
+
+
+def is_text(local_file):
+    """Return True for files that are sent in ASCII mode."""
+    return os.path.splitext(local_file)[1] in TEXT_EXTENSIONS
+
+
+def plan_uploads(file_list, manifest, listing, policy='version'):
+    """Decide what to do with every file.
+
+    Returns (tasks, skipped): tasks is a list of (file, remote name,
+    status if sent, remote size, hash, size) and skipped a dict of file ->
+    status for files that are not sent at all. The hash and size of the
+    file go into the manifest once it is sent.
+    """
+    if policy not in POLICIES:
+        raise ValueError("Unknown upload policy: {0}".format(policy))
+    tasks = []
+    skipped = {}
+    for local_file in file_list:
+        remote_name = os.path.basename(local_file)
+        sent = manifest.get(remote_name)
+        try:
+            this_hash = file_hash(local_file)
+            local_size = os.path.getsize(local_file)
+        except EnvironmentError as error:
+            skipped[local_file] = 'failed: {0}'.format(error)
+            continue
+        if sent and sent['hash'] == this_hash and sent['remote'] in listing:
+            skipped[local_file] = 'unchanged'
+            continue
+        if remote_name not in listing:
+            tasks.append((local_file, remote_name, 'uploaded', None,
+                          this_hash, local_size))
+            continue
+        size = listing[remote_name]
+        if sent is None:
+            # Sent before we kept a manifest (or by someone else). A short
+            # binary file is an interrupted upload; anything else we take
+            # to be the same file, as the old uploader did.
+            if not is_text(local_file) and size is not None and \
+                    size < local_size:
+                tasks.append((local_file, remote_name, 'resumed', size,
+                              this_hash, local_size))
+            else:
+                skipped[local_file] = 'exists'
+                manifest[remote_name] = {
+                    'hash': this_hash, 'size': local_size,
+                    'remote': remote_name}
+            continue
+        if sent['hash'] == this_hash:
+            # Sent before under sent['remote'], which is not on the server
+            # any more: only what is there under that name can be resumed.
+            offset = listing.get(sent['remote'])
+            if is_text(local_file) or offset is None or offset >= local_size:
+                status = 'uploaded'
+                if sent['remote'] != remote_name:
+                    status = 'uploaded as ' + sent['remote']
+                tasks.append((local_file, sent['remote'], status, None,
+                              this_hash, local_size))
+            else:
+                tasks.append((local_file, sent['remote'], 'resumed', offset,
+                              this_hash, local_size))
+        elif policy == 'skip':
+            skipped[local_file] = 'changed, not sent'
+        elif policy == 'overwrite':
+            tasks.append((local_file, remote_name, 'overwritten', None,
+                          this_hash, local_size))
+        else:
+            name = versioned_name(remote_name, listing)
+            listing[name] = None
+            tasks.append((local_file, name, 'uploaded as ' + name, None,
+                          this_hash, local_size))
+    return tasks, skipped
+
+
+def send_file(ftp, local_file, remote_name, offset=None,
+              block_size=BLOCK_SIZE, callback=None):
+    """Send a file, starting at offset on the server if one is given.
+
+    param: callback - Called with every block (or line) once it is sent.
+    """
+    with open(local_file, 'rb') as infile:
+        if is_text(local_file):
+            ftp.storlines("STOR " + remote_name, infile, callback)
+        elif offset:
+            infile.seek(offset)
+            ftp.storbinary(
+                "STOR " + remote_name, infile, block_size, callback,
+                rest=offset)
+        else:
+            ftp.storbinary(
+                "STOR " + remote_name, infile, block_size, callback)
+
+
+def _worker(tasks, results, lock, connect_args, block_size, retries,
+            retry_delay):
+    """Carry out upload tasks from the queue until it is empty.
+
+    A binary file is only resumed on a retry if what is on the server is
+    the start of it: the task was a resume, or a failed attempt got as far
+    as sending data. Otherwise (e.g. an overwrite that failed before its
+    STOR) the server still has the old file, and it is sent from the start.
+    """
+    ftp = None
+    while True:
+        try:
+            local_file, remote_name, status, offset, this_hash, size = \
+                tasks.get_nowait()
+        except Empty:
+            break
+        delay = retry_delay
+        sending = [status == 'resumed']
+
+        def sent_block(block, sending=sending):
+            sending[0] = True
+
+        for attempt in range(retries + 1):
+            try:
+                if ftp is None:
+                    ftp = connect(**connect_args)
+                if attempt and not is_text(local_file):
+                    # Pick up from wherever the failed attempt got to.
+                    offset = None
+                    if sending[0]:
+                        offset = remote_size(ftp, remote_name)
+                send_file(ftp, local_file, remote_name, offset, block_size,
+                          sent_block)
+                result = status
+                break
+            except all_errors as error:
+                result = 'failed: {0}'.format(error)
+                if ftp is not None:
+                    ftp.close()
+                    ftp = None
+                if attempt < retries:
+                    time.sleep(delay)
+                    delay *= 2
+            except EnvironmentError as error:
+                # A local problem (e.g. a missing file); retrying won't help.
+                result = 'failed: {0}'.format(error)
+                break
+        with lock:
+            results[local_file] = (result, remote_name, this_hash, size)
+    if ftp is not None:
+        try:
+            ftp.quit()
+        except all_errors:
+            ftp.close()
+
+
+def upload_files(file_list, policy='version', manifest_file=UPLOAD_MANIFEST,
+                 connections=FTP_CONNECTIONS, block_size=BLOCK_SIZE,
+                 retries=RETRIES, retry_delay=RETRY_DELAY, **connect_args):
+    """Upload new and changed files in parallel over a pool of connections.
+
+    param: policy - What to do with files that changed since they were
+        sent: 'skip', 'overwrite' or 'version'.
+    param: manifest_file - Where to keep the record of what was sent.
+    param: connections - Number of files to send at once.
+    param: connect_args - Passed to connect (host, remote_dir, port, ...).
+
+    Returns a dict of file -> status ('uploaded', 'resumed', 'overwritten',
+    'uploaded as <name>', 'unchanged', 'exists', 'changed, not sent' or
+    'failed: <error>'), and prints a line for every file.
+    """
+    connect_args.setdefault('host', HOST)
+    connect_args.setdefault('remote_dir', REMOTE_DIR)
+    location = connect_args['host'] + '/' + connect_args['remote_dir']
+    manifest = load_manifest(manifest_file)
+    listing = None
+    delay = retry_delay
+    for attempt in range(retries + 1):
+        try:
+            ftp = connect(**connect_args)
+            try:
+                listing = remote_listing(ftp)
+            finally:
+                ftp.close()
+            break
+        except all_errors as error:
+            status = 'failed: {0}'.format(error)
+            if attempt < retries:
+                time.sleep(delay)
+                delay *= 2
+    if listing is None:
+        for local_file in file_list:
+            print "{file}: {status} at {loc}".format(
+                file=local_file, status=status, loc=location)
+        return dict((local_file, status) for local_file in file_list)
+
+    tasks, results = plan_uploads(file_list, manifest, listing, policy)
+    queue = Queue()
+    for task in tasks:
+        queue.put(task)
+    sent = {}
+    lock = threading.Lock()
+    workers = [
+        threading.Thread(target=_worker, args=(
+            queue, sent, lock, connect_args, block_size, retries,
+            retry_delay))
+        for _ in range(min(connections, len(tasks)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for local_file, (status, remote_name, this_hash, size) in sent.items():
+        results[local_file] = status
+        if not status.startswith('failed'):
+            manifest[os.path.basename(local_file)] = {
+                'hash': this_hash,
+                'size': size,
+                'remote': remote_name,
+            }
+    save_manifest(manifest, manifest_file)
+    for local_file in file_list:
+        print "{file}: {status} at {loc}".format(
+            file=local_file, status=results[local_file], loc=location)
+    return results
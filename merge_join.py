@@ -0,0 +1,163 @@
+"""Join CSI datafiles on TIMESTAMP without shelling out to cut and join.
+
+This replaces the `cut -d "," -f ...` and `join -t "," ...` commands that
+process_smap_data_for_NASA.py used to run. Columns are picked out while
+each file is read and any number of sorted files are merged in a single
+pass, so nothing has to be written to disk and read back in between.
+
+Every table is a (header, rows) pair:
+
+    header - A list of header lines, each a list of fields. CSI datafiles
+        have four (file info, names, units, sampling); our own intermediate
+        files only have the names.
+    rows - An iterator over the data lines, each a list of fields with the
+        TIMESTAMP first.
+
+Timestamps are compared as plain strings, which for the quoted CSI format
+is the same as comparing them in time.
+"""
+from itertools import groupby, product
+from operator import itemgetter
+
+from compression import open_file
+from profiling import profiled, rows_read, rows_written
+from toa5_reader import TOA5File
+
+# Value used for fields that are missing from one side of a join.
+FILL_VALUE = '-8888'
+
+
+def read_table(input_file, variables=None, header_lines=4, offset=None,
+               end=None):
+    """Read a comma-delimited datafile, keeping only some of its columns.
+
+    param: input_file - Datafile to read.
+    param: variables - Variable names (with their double quotes) to keep.
+        Like `cut`, columns come out in the order they are in the file. The
+        first kept column is used as the join key, so this should include
+        '"TIMESTAMP"'. None keeps every column.
+    param: header_lines - Number of header lines (4 for CSI datafiles, 1
+        for the files written by the downscaler and by write_table).
+    param: offset, end - Only read the lines from the one starting at
+        byte offset to the one starting at end (see toa5_reader.py).
+
+    The file is read through a memory map (see toa5_reader.py), or as a
+    stream if it is compressed, and only the fields up to the last
+    requested column are split out of each line.
+    """
+    toa5 = TOA5File(input_file, header_lines)
+    columns = toa5.columns(variables)
+    # The file information line is not split up into columns.
+    header = [
+        line if header_lines == 4 and i == 0 else [line[c] for c in columns]
+        for i, line in enumerate(toa5.header)]
+
+    def rows():
+        n_rows = 0
+        try:
+            with toa5:
+                for row in toa5.iter_columns(variables, offset, end):
+                    n_rows += 1
+                    yield row
+        finally:
+            rows_read(n_rows)
+
+    return header, rows()
+
+
+def _names(header):
+    """Return the variable names line of a header."""
+    return header[1] if len(header) == 4 else header[0]
+
+
+def _check_sorted(rows, name):
+    """Pass rows through, raising a ValueError if they are out of order."""
+    last_key = None
+    for row in rows:
+        if last_key is not None and row[0] < last_key:
+            raise ValueError("{0} is not sorted: {1} follows {2}".format(
+                name, row[0], last_key))
+        last_key = row[0]
+        yield row
+
+
+def merge_join(tables, how='inner', fill=FILL_VALUE):
+    """Join any number of tables on their first column in one pass.
+
+    param: tables - A list of (header, rows) tables, each sorted on its
+        first column.
+    param: how - 'inner' keeps keys found in every table (like `join`),
+        'left' keeps every key of the first table (like `join -a1`) and
+        'outer' keeps every key of any table.
+    param: fill - Value used for the columns of a table that has no row
+        for a key (like `join -e`).
+
+    Returns a (header, rows) table with the key followed by the other
+    columns of each table in turn. When a key repeats in more than one
+    table, every combination of rows is returned, as `join` does.
+    """
+    if how not in ('inner', 'left', 'outer'):
+        raise ValueError("Unknown join type: {0}".format(how))
+    headers = [header for header, _ in tables]
+    widths = [len(_names(header)) - 1 for header in headers]
+    if all(len(header) == 4 for header in headers):
+        # Keep a full CSI header: the first file's information line, then
+        # the names, units and sampling of every column.
+        header = [headers[0][0]] + [
+            headers[0][i][:1] + sum([h[i][1:] for h in headers], [])
+            for i in range(1, 4)]
+    else:
+        header = [
+            _names(headers[0])[:1] +
+            sum([_names(h)[1:] for h in headers], [])]
+
+    groups = [
+        groupby(_check_sorted(rows, i), key=itemgetter(0))
+        for i, (_, rows) in enumerate(tables)]
+
+    def rows():
+        current = [next(group, None) for group in groups]
+        while True:
+            keys = [c[0] for c in current if c is not None]
+            if not keys or (how == 'left' and current[0] is None):
+                return
+            key = min(keys)
+            matches = []
+            for i, c in enumerate(current):
+                if c is not None and c[0] == key:
+                    matches.append(list(c[1]))
+                    current[i] = next(groups[i], None)
+                else:
+                    matches.append(None)
+            if how == 'inner' and None in matches:
+                continue
+            if how == 'left' and matches[0] is None:
+                continue
+            choices = [
+                match or [[key] + [fill] * widths[i]]
+                for i, match in enumerate(matches)]
+            for combination in product(*choices):
+                row = [key]
+                for this_row in combination:
+                    row.extend(this_row[1:])
+                yield row
+
+    return header, rows()
+
+
+@profiled
+def write_table(table, output_file):
+    """Write a (header, rows) table to a comma-delimited file.
+
+    The file is compressed if its name ends in .gz, .bz2 or .xz (see
+    compression.py).
+    """
+    header, rows = table
+    n_rows = 0
+    with open_file(output_file, 'w') as out_file:
+        for line in header:
+            out_file.write(','.join(line) + '\n')
+        for row in rows:
+            out_file.write(','.join(row) + '\n')
+            n_rows += 1
+    rows_written(n_rows)
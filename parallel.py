@@ -0,0 +1,141 @@
+"""Run independent jobs in a pool of worker processes.
+
+Each logger's chain of work (downscale -> join -> format) does not depend
+on any other logger until the files are uploaded. So every stage (see
+stages.py) is handed to a JobPool as soon as the stages it needs have
+finished, and a run takes about as long as the slowest logger's chain
+instead of the sum. run_jobs runs a list of jobs that are all ready at
+once and waits for the slowest.
+"""
+import multiprocessing
+import os
+import traceback
+from Queue import Queue, Empty
+
+
+def default_workers():
+    """Return the number of workers to use when none is given.
+
+    Set SMAP_WORKERS in the environment to override the number of CPUs.
+    """
+    return int(os.environ.get('SMAP_WORKERS') or multiprocessing.cpu_count())
+
+
+def _call(func, args):
+    """Run func(*args), returning (result, None) or (None, traceback)."""
+    try:
+        return func(*args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class JobPool(object):
+    """Run jobs in worker processes, collecting each one as it finishes.
+
+        pool = JobPool(workers=4)
+        pool.submit('downscale Open', downscale, args)
+        name, result, error = pool.next_done()  # Whichever finishes first
+        pool.close()
+
+    error is the formatted traceback of a job that raised, or None. As for
+    run_jobs, func must be a module level function, and with one worker
+    (or inside a pool worker) the jobs run in this process as they are
+    submitted.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = default_workers()
+        self.workers = max(1, workers)
+        self.running = 0
+        self._pool = None
+        self._pending = []
+        self._done = Queue()
+
+    def submit(self, name, func, args):
+        """Start func(*args)."""
+        self.running += 1
+        if self.workers == 1 or multiprocessing.current_process().daemon:
+            self._done.put((name,) + _call(func, args))
+            return
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers)
+        job = self._pool.apply_async(
+            _call, (func, args),
+            callback=lambda outcome: self._done.put((name,) + outcome))
+        self._pending.append((name, job))
+
+    def next_done(self):
+        """Wait for a job to finish. Returns (name, result, error)."""
+        if not self.running:
+            raise ValueError("No jobs are running")
+        while True:
+            try:
+                # With a timeout, so that Ctrl-C is not held up.
+                outcome = self._done.get(timeout=0.1)
+                break
+            except Empty:
+                # A result that could not be sent back never gets to
+                # the callback.
+                failed = [
+                    (name, job) for name, job in self._pending
+                    if job.ready() and not job.successful()]
+                if failed:
+                    name, job = failed[0]
+                    try:
+                        job.get()
+                    except Exception:
+                        outcome = (name, None, traceback.format_exc())
+                    break
+        self._pending = [
+            (name, job) for name, job in self._pending
+            if name != outcome[0]]
+        self.running -= 1
+        return outcome
+
+    def close(self):
+        """Wait for the worker processes to exit."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def run_jobs(jobs, workers=None):
+    """Run every job, in parallel, and collect the outcomes.
+
+    param: jobs - A list of (name, func, args) triples; func(*args) is run
+        for each. func must be a module level function so that it can be
+        pickled.
+    param: workers - Number of worker processes. With 1 the jobs run one
+        after another in this process, which is handy for debugging. Pool
+        workers cannot start pools of their own, so jobs started from one
+        (e.g. a parallel downscale in a stage) also run in its process.
+
+    Returns (results, errors): two lists of (name, value) pairs in the
+    order the jobs were given, whatever order they finish in. errors holds
+    the formatted traceback of every job that raised.
+    """
+    if workers is None:
+        workers = default_workers()
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1 or multiprocessing.current_process().daemon:
+        outcomes = [_call(func, args) for _, func, args in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = [
+                pool.apply_async(_call, (func, args))
+                for _, func, args in jobs]
+            outcomes = [job.get() for job in pending]
+        finally:
+            pool.close()
+            pool.join()
+    results = []
+    errors = []
+    for (name, _, _), (result, error) in zip(jobs, outcomes):
+        if error is None:
+            results.append((name, result))
+        else:
+            errors.append((name, error))
+    return results, errors
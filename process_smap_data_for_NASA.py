@@ -4,127 +4,74 @@ K. Caylor, April 2, 2016
 
 Steps:
 
-1.
-2.
-3.
-4.
-5.
-6.
+1. Define the logger files and the variables we need from each.
+2. Run the stages that are out of date (see stages.py): for the tower
+   and each CR216 logger, in parallel, join the files, downscale to
+   hourly, add the air temperature and write the SMAP files; then upload
+   the SMAP files and clean up.
+3. Keep the watermarks of the loggers that were joined or downscaled.
+
+A stage whose outputs are newer than its inputs is skipped, so after a
+failure running again only redoes what failed and what depends on it.
+Use --stage to bring only some stages up to date. What every stage cost
+is written to profile_report.json (see profiling.py).
+
+Logger files that have been archived compressed (e.g.
+CR216_SN22028_soil.dat.gz) are read as they are. With --compress gz (or
+bz2, xz) the SMAP files and the tenMinuteTable and smapdata files are
+written compressed too.
 
 
 """
+import argparse
 import os
-from ftplib import FTP
-from subprocess import call, check_output
-from downscalers import downscale_to_hourly
-from smap_tower_functions import make_smap_data_for_tower_sites
+import sys
+from subprocess import call
+import column_cache
+from completeness import completeness_file
+from compression import COMPRESSIONS, compressed_name, find_file, \
+    is_compressed, open_file
+from csi_time import compact_date, parse_hour
+from downscalers import downscale_incremental
+from ftp_upload import POLICIES, upload_files
+from merge_join import merge_join, read_table, write_table
+from profiling import REPORT_FILE, profile_options, rows_written
+from stages import BLOCKED, FAILED, RAN, run_stages, stage
+from toa5_index import last_timestamp, record_offset, seek_offset, \
+    update_index
+from toa5_sort import KEEP_POLICIES, read_sorted_table, sort_datafile
+from watermarks import load_watermarks, resume_offset, save_watermarks
+from smap_tower_functions import CALIBRATION_FILE, \
+    make_smap_data_for_tower_sites
 from smap_basin_functions import make_smap_data_for_basin_sites
 
 
 def cleanup():
-    """Remove temporary files."""
+    """Remove temporary files.
+
+    The sixtyMinuteTable files are kept, with their completeness files:
+    the next run only downscales the records appended since this one and
+    merges them in (see watermarks.py and completeness.py). So is the
+    tenMinuteTable, which the next run only appends the new rows to.
+    """
     commands = [
-        'rm sixtyMinuteTable*',
-        'rm tenMinuteTable',
         'rm smapdata*',
-        'rm table1.dat',
-        'rm table2.dat',
-        'rm table3.dat',
-        'rm table4.dat',
-        'rm table5.dat',
-        'rm upper.dat',
-        'rm flux.dat',
     ]
     print "Cleaning up temporary files."
     [call(command, shell=True) for command in commands]
 
 
-def upload(ftp, file):
-    """Upload a file to an ftp site."""
-    ext = os.path.splitext(file)[1]
-    if ext in (".txt", ".htm", ".html"):
-        # By default, we do not over-write.
-        if not ftp.size(file):
-            ftp.storlines("STOR " + file, open(file))
-            print "Uploaded {file} to {loc}".format(
-                file=file,
-                loc=ftp.host + ftp.pwd()
-            )
-        else:
-            print "{file} already exists at {loc}".format(
-                file=file,
-                loc=ftp.host + ftp.pwd())
-    else:
-        # By default, we do not over-write.
-        if not ftp.size(file):
-            ftp.storbinary("STOR " + file, open(file, "rb"), 1024)
-            print "Uploaded {file} to {loc}".format(
-                file=file,
-                loc=ftp.host + ftp.pwd()
-            )
-        else:
-            print "{file} already exists at {loc}".format(
-                file=file,
-                loc=ftp.host + ftp.pwd())
-
-
-def ftp_files(file_list):
-    """Transfer SMAP files to ftp server."""
-    # SET UP ftp TRANSFER
-    host = 'enso.princeton.edu'       # server address
-    ftp = FTP(host)
-    ftp.login()
-    ftp.cwd('incoming/Caylor_smap/')
-    for file in file_list:
-        upload(ftp, file)
-    return "SMAP transfer successful"
-
-
-def join(left_file, right_file, output_file):
-    """Join two files into a third."""
-    delim = ','
-    cmd = 'join -t "{delim}" '.format(delim=delim)
-    cmd += '{left_file} {right_file} > {output_file}'.format(
-        left_file=left_file,
-        right_file=right_file,
-        output_file=output_file)
-    call(cmd, shell=True)
-
-
-def cut(input_file, output_file, variables=[]):
-    """Cut out columns from a datafile and save to new file.
-
-    Assumes comma-delimited
-
-    param: input_file - Datafile to remove columns from
-    param: output_file - New file to be created from selected columns
-    param: columns - List of columns to cut
-    """
-    if variables:
-        file_vars = get_vars(input_file)
-        columns = [file_vars.index(var) for var in variables]
-        cols = ','.join([str(x+1) for x in columns])
-        cut_cmd = 'cut -d ","  -f {cols} '.format(
-            cols=cols
-        )
-        cut_cmd += '"{input_file}" > {output_file}'.format(
-            input_file=input_file,
-            output_file=output_file)
-        call(cut_cmd, shell=True)
-
-
-def remove_lines(input_file, remove_lines=[]):
-    """Remove specified lines from a file.
-
-    param: input_file - The name of the file to workon.
-        This file will be over-written in place.
-
-    param: remove_lines - An array of lines to remove.
+def ftp_files(file_list, policy='version'):
+    """Transfer new and changed SMAP files to ftp server.
+
+    param: policy - What to do with files that changed since they were
+        last sent ('skip', 'overwrite' or 'version'; see ftp_upload).
+
+    Returns the files that could not be sent.
     """
-    lines = open(input_file, 'r').readlines()
-    keepers = set(range(len(lines))) - set(remove_lines)
-    outlines = [lines[i] for i in keepers]
-    open(input_file, 'w').writelines(outlines)
+    results = upload_files(file_list, policy=policy)
+    return [
+        file for file in file_list if results[file].startswith('failed')]
 
 
 def get_vars(input_file):
@@ -135,8 +82,9 @@ def get_vars(input_file):
     Returns a list of variables found in the file.
 
     """
-    cmd = 'head -2 "{filename}" | tail -1'.format(filename=input_file)
-    variables = check_output(cmd, shell=True)
+    with open_file(input_file, 'r') as in_file:
+        in_file.readline()
+        variables = in_file.readline()
     return [x.rstrip() for x in variables.split(',')]
 
 
@@ -164,68 +112,47 @@ def variables_to_keep(variables=[]):
         vars_to_keep.append(name)
     return vars_to_keep
 
-# STEP 1: Define files and create temporary files with needed variables.
+# STEP 1: Define files. The columns we need are picked out of each file
+# as it is read by merge_join, so no temporary copies are made. A file
+# that has been archived compressed is read from its archive.
 (data_dir, _) = os.path.split(os.getcwd())
-upper_file = data_dir + '/' + 'CR5000_SN2446_upper.dat'
-soil_moisture_file = data_dir + '/' + 'CR3000_SN9945_Table1.dat'
-flux_data_file = data_dir + '/' + 'CR3000_SN4709_flux.dat'
-
-# Remove the timestamp and last column from the upper file and save
-# result to upper.dat
-success = cut(
-    upper_file,
-    'upper.dat',
-    variables=['"TIMESTAMP"', '"rainfall_Tot"'])
-success = cut(
-    soil_moisture_file,
-    'table1.dat',
-    variables=variables_to_keep(get_vars(soil_moisture_file))
-)
-success = cut(
-    flux_data_file,
-    'flux.dat',
-    variables=['"TIMESTAMP"', '"t_hmp_Avg"'])
-# Trim the CSI junk out of flux.dat (meta, units, type)
-remove_lines('flux.dat', [0, 2, 3])
-remove_lines('table1.dat', [0, 2, 3])
-remove_lines('upper.dat', [0, 2, 3])
-
-# STEP 2: Process the CR216 files.
+upper_file = find_file(data_dir + '/' + 'CR5000_SN2446_upper.dat')
+soil_moisture_file = find_file(data_dir + '/' + 'CR3000_SN9945_Table1.dat')
+flux_data_file = find_file(data_dir + '/' + 'CR3000_SN4709_flux.dat')
+
 # All the CR216 files. We should get CR216_SN22027_soil.dat someday.
+# The CR216 files are downscaled straight from TowerData, so that only the
+# records added since the last run have to be read. The last entry is the
+# basin site in smap_basin_functions that each file belongs to, and its
+# SMAP station number.
 CR216_files = {
     'CR216_SN22028_soil.dat': [
-        'table2.dat',
         'sixtyMinuteTable2',
-        'smapdata2'],
+        'smapdata2',
+        'Euphorbia',
+        '005'],
     'CR216_SN22029_soil.dat': [
-        'table3.dat',
         'sixtyMinuteTable3',
-        'smapdata3'],
+        'smapdata3',
+        'Open',
+        '006'],
     'CR216_SN22030_soil.dat': [
-        'table4.dat',
         'sixtyMinuteTable4',
-        'smapdata4'],
+        'smapdata4',
+        'River',
+        '007'],
     'CR216_SN22031_soil.dat': [
-        'table5.dat',
         'sixtyMinuteTable5',
-        'smapdata5']
+        'smapdata5',
+        'Glade',
+        '008']
 }
 
-# Process each soil file, keeping only the good columns.
-for soil_file in CR216_files.keys():
-    this_file = data_dir + '/' + soil_file
-    success = cut(
-        this_file,
-        CR216_files[soil_file][0],
-        variables=variables_to_keep(get_vars(this_file))
-    )
-
-# STEP 3: Combine data before downscaling.
-join('table1.dat', 'upper.dat', 'tenMinuteTable')
-
-# STEP 4: Downscale everything to hourly data.
-# Downscale the Tower site rainfall, soil moisture, and temp data.
-# Note: Variable names are always wrapped in double quotes.
+# The tower SMAP station numbers (Tree, Grass, Open, Riparian).
+TOWER_STATIONS = ['001', '002', '003', '004']
+
+# Variables to downscale. Note: Variable names are always wrapped in
+# double quotes.
 tenMinuteTable_sum_vars = ['"rainfall_Tot"']
 tenMinuteTable_sample_vars = [
     '"VW005cmTree_v0_Avg"',
@@ -276,18 +203,6 @@ tenMinuteTable_sample_vars = [
     '"Tsoil20cmOpen_Avg"',
 ]
 
-downscale_to_hourly(
-    input_file='tenMinuteTable',
-    output_file='sixtyMinuteTable',
-    sum_vars=tenMinuteTable_sum_vars,
-    sample_vars=tenMinuteTable_sample_vars)
-
-cmd = 'join -t "," -a1 -1 1 -2 1 -e "-8888" {inf} flux.dat > {outf}'.format(
-    inf='sixtyMinuteTable',
-    outf='smapdata')
-call(cmd, shell=True)
-
-# Downscale the SMAP site rainfall, soil moisture, and temp data.
 CR216_sum_vars = ['"Rain_mm_Tot"']
 CR216_sample_vars = [
     '"VW_20cm_Avg"',
@@ -296,29 +211,437 @@ CR216_sample_vars = [
     '"Temp_05cm_Avg"'
 ]
 
-for soil_file in CR216_files.keys():
-    downscale_to_hourly(
-        input_file=CR216_files[soil_file][0],
-        output_file=CR216_files[soil_file][1],
-        sum_vars=CR216_sum_vars,
-        sample_vars=CR216_sample_vars
-    )
-    # Do the major joins, with substitution:
-    cmd = 'join -t "," -a2 -e "-8888" -o 0,2.2,2.3,2.4,2.5,2.6,1.2 '
-    cmd += 'flux.dat {joinfile} > {outfile}'.format(
-        joinfile=CR216_files[soil_file][1],
-        outfile=CR216_files[soil_file][2]
-    )
-    call(cmd, shell=True)
-
-# STEP 5: Make the final SMAP data files that will be FTP'd
-files_for_upload = []
-tower_files = make_smap_data_for_tower_sites()
-basin_files = make_smap_data_for_basin_sites()
-files_for_upload.extend(tower_files)
-files_for_upload.extend(basin_files)
-
-ftp_files(files_for_upload)
-cleanup()
-
-print "We made it."
+
+def own_marks(marks, *input_files):
+    """Return a watermark store holding only the entries for input_files."""
+    return dict((k, v) for k, v in marks.items() if k in input_files)
+
+
+def report_duplicates(input_file, stats):
+    """Print how many records of a file were out of order or dropped."""
+    if stats.get('unsorted'):
+        print "{0}: {1} records out of order or repeated, {2} dropped".format(
+            os.path.basename(input_file), stats['unsorted'],
+            stats['duplicates'])
+
+
+def sorted_table(input_file, variables, keep, header_lines=4):
+    """Read some columns of a logger file, sorted and one row per time.
+
+    Returns (table, stats); see toa5_sort.read_sorted_table. Loggers can
+    append overlapping or out of order records after a clock reset or when
+    data is collected again.
+    """
+    stats = {}
+    table = read_sorted_table(
+        input_file, variables, header_lines, keep=keep, stats=stats)
+    return table, stats
+
+
+def flux_table(keep='last'):
+    """Return the TIMESTAMP and air temperature columns of the flux file.
+
+    Returns (table, stats) (see sorted_table). Only its records at the top
+    of the hour are needed, and they are read through the column cache
+    (see column_cache.py) if numpy is installed. Then records out of order
+    are sorted in memory, and the file is not read again to do it.
+    """
+    variables = ['"TIMESTAMP"', '"t_hmp_Avg"']
+    if column_cache.np is not None:
+        stats = {}
+        unsorted = update_index(flux_data_file)['unsorted']
+        table = column_cache.hourly_table(
+            flux_data_file, variables, keep=keep if unsorted else None,
+            stats=stats)
+        return table, stats
+    return sorted_table(flux_data_file, variables, keep)
+
+
+def smap_files(sm_file, station_numbers, compression=None):
+    """Return the names of the SMAP files made from an smapdata file.
+
+    They are dated by the last record of sm_file, as in the writers
+    (2401001_20160121.txt, or 2401001_20160121.txt.gz with compression).
+    Returns [] if sm_file has not been made yet.
+    """
+    if not os.path.exists(sm_file):
+        return []
+    date = compact_date(last_timestamp(sm_file, header_lines=1))
+    return [
+        compressed_name('2401' + number + '_' + date + '.txt', compression)
+        for number in station_numbers]
+
+
+def join_mark(input_file, index, cut, variables, output_file):
+    """Return the watermark of a logger file joined into output_file.
+
+    param: index - The index of input_file (see toa5_index).
+    param: cut - The last timestamp that every joined file had reached.
+
+    The watermark (see watermarks.py) is at the index entry before cut,
+    the start of a record that is complete even if the logger is still
+    writing the one after it. The records from there up to cut have been
+    joined already; cut is kept so that they can be skipped. It also has
+    the variables joined and the size output_file has now.
+    """
+    offset = seek_offset(index, cut)
+    with open_file(input_file, 'rb') as in_file:
+        in_file.seek(offset)
+        timestamp = in_file.readline().split(',')[0]
+    return {
+        'offset': offset,
+        'timestamp': timestamp,
+        'last_timestamp': index['last'],
+        'cut': cut,
+        'header': index['header'],
+        'size': os.path.getsize(input_file),
+        'columns': variables,
+        'output_size': os.path.getsize(output_file),
+    }
+
+
+def join_tower(keep='last', ten_file='tenMinuteTable', marks=None):
+    """Join the tower soil moisture and rainfall into tenMinuteTable.
+
+    param: keep - Which of several records with the same timestamp to use
+        ('first' or 'last'; see toa5_sort.py).
+    param: ten_file - Where to write the joined file (compressed if its
+        name ends in .gz, .bz2 or .xz).
+    param: marks - The watermark store (see watermarks.py). The entries of
+        the two logger files are read and updated in place.
+
+    Only the records appended to the logger files since the last run are
+    joined, and their rows are appended to ten_file. That is every record
+    after the last time both files had reached (see join_mark): a later
+    record of one file may still match an earlier one of the other. The
+    whole join is written again (from sorted copies, if either file has
+    records out of order or repeated) if either file was rotated or has
+    had records come out of order since the last run, if ten_file is not
+    as it was left, or if it is compressed (it cannot be appended to).
+
+    Returns the updated watermarks.
+    """
+    if marks is None:
+        marks = {}
+    # Only the rainfall is needed from the upper file. The joined file keeps
+    # the four CSI header lines that the downscaler expects.
+    files = [
+        (soil_moisture_file,
+         variables_to_keep(get_vars(soil_moisture_file))),
+        (upper_file, ['"TIMESTAMP"', '"rainfall_Tot"'])]
+    indexes = [update_index(input_file) for input_file, _ in files]
+    offsets = [
+        resume_offset(input_file, marks.get(input_file))
+        for input_file, _ in files]
+    # Records out of order before the watermarks have been joined already,
+    # so only the sorted tail of each file (see toa5_index) is read again.
+    append = (
+        not is_compressed(ten_file) and os.path.exists(ten_file) and
+        None not in offsets and all(
+            offset >= index['sorted_from'] and
+            marks[input_file]['columns'] == variables and
+            marks[input_file].get('cut') == marks[files[0][0]].get('cut') and
+            marks[input_file]['output_size'] == os.path.getsize(ten_file)
+            for (input_file, variables), offset, index in zip(
+                files, offsets, indexes)))
+    if append:
+        joined = merge_join([
+            read_table(input_file, variables, offset=offset, end=index['end'])
+            for (input_file, variables), offset, index in zip(
+                files, offsets, indexes)])
+        cut = marks[files[0][0]]['cut']
+        n_rows = 0
+        with open(ten_file, 'a') as out_file:
+            for row in joined[1]:
+                if row[0] > cut:
+                    out_file.write(','.join(row) + '\n')
+                    n_rows += 1
+        rows_written(n_rows)
+    elif any(index['unsorted'] for index in indexes):
+        tables = [
+            sorted_table(input_file, variables, keep)
+            for input_file, variables in files]
+        write_table(merge_join([table for table, _ in tables]), ten_file)
+        for (input_file, _), (_, stats) in zip(files, tables):
+            report_duplicates(input_file, stats)
+    else:
+        write_table(merge_join([
+            read_table(input_file, variables, end=index['end'])
+            for (input_file, variables), index in zip(files, indexes)]),
+            ten_file)
+    cut = min(index['latest'] for index in indexes)
+    for (input_file, variables), index in zip(files, indexes):
+        # A record out of order after cut has not been joined in its place;
+        # an empty watermark makes the next run start from the beginning.
+        if cut is None or (index['sorted_after'] is not None and
+                           index['sorted_after'] >= cut):
+            marks[input_file] = {}
+        else:
+            marks[input_file] = join_mark(
+                input_file, index, cut, variables, ten_file)
+    return marks
+
+
+def tail_mark(input_file, index, mark):
+    """Move the watermark of a sorted copy of input_file onto input_file.
+
+    param: index - The index of input_file (see toa5_index).
+    param: mark - The watermark the sorted copy was downscaled to.
+
+    This works when every record of the last hour downscaled is in the
+    sorted tail of input_file, after every record of an earlier hour; then
+    going on from there reads the same records as going on in the copy
+    would. Returns {} (start from the beginning) otherwise.
+    """
+    if not mark or index['sorted_after'] is None or \
+            parse_hour(mark['timestamp'])[0] <= \
+            parse_hour(index['sorted_after'])[0]:
+        return {}
+    offset = record_offset(input_file, index, mark['timestamp'])
+    with open_file(input_file, 'rb') as in_file:
+        in_file.seek(offset)
+        if in_file.readline().split(',')[0] != mark['timestamp']:
+            return {}
+    return dict(mark, offset=offset, size=index['size'])
+
+
+def downscale(input_file, output_file, sum_vars, sample_vars, marks,
+              keep=None):
+    """Downscale input_file to hourly. Returns the updated watermarks.
+
+    param: keep - For a logger file, which of several records with the
+        same timestamp to use ('first' or 'last'). If the file has records
+        out of order or repeated (see toa5_index), a sorted copy of it is
+        downscaled from the start instead. The watermark is then moved
+        onto the file's sorted tail where it can be (see tail_mark), so
+        that later runs only read the records appended after it, until
+        more come out of order. None for files we made ourselves, which
+        are already sorted.
+    """
+    index = None if keep is None else update_index(input_file)
+    if index is not None and index['unsorted']:
+        if downscale_incremental(
+                input_file=input_file,
+                output_file=output_file,
+                sum_vars=sum_vars,
+                sample_vars=sample_vars,
+                marks=marks,
+                min_offset=index['sorted_from']) is not None:
+            return marks
+        sorted_file = os.path.basename(input_file) + '.sorted'
+        stats = sort_datafile(input_file, sorted_file, keep=keep)
+        report_duplicates(input_file, stats)
+        sorted_marks = {}
+        try:
+            downscale_incremental(
+                input_file=sorted_file,
+                output_file=output_file,
+                sum_vars=sum_vars,
+                sample_vars=sample_vars,
+                marks=sorted_marks)
+        finally:
+            os.remove(sorted_file)
+        marks[input_file] = tail_mark(
+            input_file, index, sorted_marks.get(sorted_file))
+        return marks
+    downscale_incremental(
+        input_file=input_file,
+        output_file=output_file,
+        sum_vars=sum_vars,
+        sample_vars=sample_vars,
+        marks=marks)
+    return marks
+
+
+def add_air_temperature(sixty_file, smap_file, keep='last'):
+    """Add the air temperature to every hour (-8888 where it is missing)."""
+    flux, flux_stats = flux_table(keep)
+    write_table(
+        merge_join(
+            [read_table(sixty_file, header_lines=1), flux], how='left'),
+        smap_file)
+    report_duplicates(flux_data_file, flux_stats)
+
+
+def format_basin_site(site, compression=None):
+    """Write the SMAP file of one basin site. Returns its name."""
+    return make_smap_data_for_basin_sites(
+        site_names=[site], compression=compression)
+
+
+def upload(policy, compression=None):
+    """Upload the SMAP files that were made.
+
+    Raises IOError if any of them could not be sent.
+    """
+    file_list = [
+        file for file in all_smap_files(compression)
+        if os.path.exists(file)]
+    failed_uploads = ftp_files(file_list, policy)
+    if failed_uploads:
+        raise IOError("Could not upload " + ', '.join(failed_uploads))
+
+
+def tower_smap_files(compression=None):
+    """Return the names of the tower SMAP files."""
+    return smap_files(
+        compressed_name('smapdata', compression), TOWER_STATIONS,
+        compression)
+
+
+def all_smap_files(compression=None):
+    """Return the names of every SMAP file."""
+    file_list = tower_smap_files(compression)
+    for soil_file in sorted(CR216_files.keys()):
+        _, smap_file, _, number = CR216_files[soil_file]
+        file_list.extend(smap_files(
+            compressed_name(smap_file, compression), [number], compression))
+    return file_list
+
+
+def pipeline(marks, policy='version', keep='last', compression=None):
+    """Return the stages of the pipeline (see stages.py).
+
+    Each logger's branch (join -> downscale -> join -> format) only reads
+    and writes its own files, so the branches run at the same time. The
+    columns we need are picked out of each file as it is read, so there is
+    no separate cut stage. Each downscale stage only gets the watermark of
+    its own input, and the tower join those of its two logger files, and
+    they return them updated. Records of the logger files that
+    are out of order are sorted, and of several records with the same
+    timestamp only the first or last (keep) is used.
+
+    With compression ('gz', 'bz2' or 'xz') the tenMinuteTable, smapdata
+    and SMAP files are written compressed. The sixtyMinuteTable files are
+    updated in place from run to run, so they are not.
+    """
+    flux = [flux_data_file]
+    ten_file = compressed_name('tenMinuteTable', compression)
+    tower_file = compressed_name('smapdata', compression)
+    stages = [
+        stage('join tower', join_tower,
+              (keep, ten_file,
+               own_marks(marks, soil_moisture_file, upper_file)),
+              inputs=[soil_moisture_file, upper_file],
+              outputs=[ten_file]),
+        stage('downscale tower', downscale,
+              (ten_file, 'sixtyMinuteTable',
+               tenMinuteTable_sum_vars, tenMinuteTable_sample_vars,
+               own_marks(marks, ten_file)),
+              inputs=[ten_file],
+              outputs=['sixtyMinuteTable',
+                       completeness_file('sixtyMinuteTable')]),
+        stage('join tower air temperature', add_air_temperature,
+              ('sixtyMinuteTable', tower_file, keep),
+              inputs=['sixtyMinuteTable'] + flux,
+              outputs=[tower_file]),
+        stage('format tower', make_smap_data_for_tower_sites,
+              (None, compression),
+              inputs=[tower_file, CALIBRATION_FILE],
+              outputs=lambda: tower_smap_files(compression)),
+    ]
+    for soil_file in sorted(CR216_files.keys()):
+        sixty_file, smap_file, site, number = CR216_files[soil_file]
+        smap_file = compressed_name(smap_file, compression)
+        input_file = find_file(data_dir + '/' + soil_file)
+        stages.extend([
+            stage('downscale ' + site, downscale,
+                  (input_file, sixty_file, CR216_sum_vars, CR216_sample_vars,
+                   own_marks(marks, input_file), keep),
+                  inputs=[input_file],
+                  outputs=[sixty_file, completeness_file(sixty_file)]),
+            stage('join {0} air temperature'.format(site),
+                  add_air_temperature, (sixty_file, smap_file, keep),
+                  inputs=[sixty_file] + flux,
+                  outputs=[smap_file]),
+            stage('format ' + site, format_basin_site, (site, compression),
+                  inputs=[smap_file],
+                  outputs=lambda s=smap_file, n=number: smap_files(
+                      s, [n], compression)),
+        ])
+    formats = [s['name'] for s in stages if s['name'].startswith('format')]
+    stages.extend([
+        # Send whatever was made, even if some loggers failed.
+        stage('upload', upload, (policy, compression), after=formats,
+              despite_failures=True),
+    ])
+    # Only clean up once everything worked, so that a failed run can be
+    # picked up where it stopped.
+    stages.append(
+        stage('cleanup', cleanup, after=[s['name'] for s in stages]))
+    return stages
+
+
+def keep_watermarks(watermarks, outcomes):
+    """Save the watermarks of the join and downscale stages that ran.
+
+    param: outcomes - What run_stages returned for the pipeline.
+
+    The failed stages are printed. Returns False if any stage failed or
+    was blocked.
+    """
+    failed = False
+    for name, (outcome, value) in sorted(outcomes.items()):
+        if outcome == RAN and (
+                name.startswith('downscale') or name == 'join tower'):
+            watermarks.update(value)
+        elif outcome == FAILED:
+            print "Stage {name} failed:\n{error}".format(
+                name=name, error=value)
+        failed = failed or outcome in (FAILED, BLOCKED)
+    save_watermarks(watermarks)
+    return not failed
+
+
+def main():
+    """Run the stages that are out of date, then report how it went."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of stages to run at once (default: SMAP_WORKERS '
+             'or the number of CPUs).')
+    parser.add_argument(
+        '--upload-policy', choices=POLICIES, default='version',
+        help='What to do with files that changed since they were last '
+             'sent: leave the old copy (skip), replace it (overwrite) or '
+             'send the new one as name_vN (version, the default).')
+    parser.add_argument(
+        '--duplicates', choices=KEEP_POLICIES, default='last',
+        help='Which of several logger records with the same timestamp to '
+             'use: the first or the last one appended (the default).')
+    parser.add_argument(
+        '--compress', choices=COMPRESSIONS, default=None,
+        help='Write the SMAP files, tenMinuteTable and smapdata files '
+             'compressed (default: plain text). Compressed logger files '
+             'are always read.')
+    parser.add_argument(
+        '--stage', action='append', dest='targets', metavar='NAME',
+        help='Only bring this stage (and the stages it needs) up to date. '
+             'May be given more than once.')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Run every stage, even those that are up to date.')
+    parser.add_argument(
+        '--profile', default=None, metavar='OPTIONS',
+        help='Extra profiling: cprofile and/or memory, comma separated '
+             '(default: SMAP_PROFILE). Timings are always written to '
+             + REPORT_FILE + '.')
+    args = parser.parse_args()
+
+    # STEP 2: Run every stage that is out of date.
+    watermarks = load_watermarks()
+    outcomes = run_stages(
+        pipeline(watermarks, args.upload_policy, args.duplicates,
+                 args.compress),
+        workers=args.workers,
+        targets=args.targets, force=args.force, report_file=REPORT_FILE,
+        profile=profile_options(args.profile))
+
+    # STEP 3: Keep the watermarks of the join and downscale stages that ran.
+    if not keep_watermarks(watermarks, outcomes):
+        sys.exit(1)
+    print "We made it."
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""Measure what every step of a run costs, and write it down.
+
+Every stage run by stages.run_stages is measured, and so is every call to
+a function decorated with @profiled (the downscalers and the SMAP file
+writers). For each we record:
+
+    wall_seconds, cpu_seconds - elapsed and CPU (user + system) time
+    peak_rss_mb - the largest resident set size while it ran
+    bytes_read, bytes_written - I/O done by the process (from
+        /proc/self/io; None where that is not available). Reads through
+        a memory map (toa5_reader) are not counted.
+
+Stages also get the data rows they read and wrote (rows_in and rows_out,
+counted by the readers with rows_read and the writers with rows_written,
+so a stage that only reads the records appended since the last run and
+appends their rows counts only those) and the bytes of their input and
+output files (input_bytes, output_bytes). The report of a run is a JSON file (REPORT_FILE) written
+next to the outputs.
+
+More detail can be asked for with SMAP_PROFILE (or --profile), a comma
+separated list of:
+
+    cprofile - save a cProfile of every stage to PROFILE_DIR/<stage>.prof
+        (read them with pstats, or snakeviz)
+    memory - record the peak memory allocated by Python and the lines that
+        allocated most, with tracemalloc. Python 2 has no tracemalloc; the
+        pytracemalloc backport provides it, on a patched interpreter.
+        Without it this option is ignored.
+"""
+import cProfile
+import functools
+import json
+import os
+import re
+import resource
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Only on Python 3, or with pytracemalloc.
+    tracemalloc = None
+
+PROFILE_ENV = 'SMAP_PROFILE'
+PROFILE_OPTIONS = ('cprofile', 'memory')
+REPORT_FILE = 'profile_report.json'
+PROFILE_DIR = 'profiles'
+
+# Records of the @profiled calls made in this process since the last
+# stage started.
+_calls = []
+
+# Data rows read and written in this process since the last stage started.
+_rows_in = [0]
+_rows_out = [0]
+
+
+def profile_options(options=None):
+    """Return the set of extra profiling options asked for.
+
+    param: options - A comma separated string; by default SMAP_PROFILE.
+    """
+    if options is None:
+        options = os.environ.get(PROFILE_ENV, '')
+    options = set(o.strip() for o in options.split(',') if o.strip())
+    unknown = options - set(PROFILE_OPTIONS)
+    if unknown:
+        raise ValueError("Unknown profiling options: {0}".format(
+            ', '.join(sorted(unknown))))
+    return options
+
+
+def _io():
+    """Return (bytes read, bytes written) by this process, or (None, None)."""
+    try:
+        with open('/proc/self/io', 'r') as infile:
+            counters = dict(line.split(':') for line in infile)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+
+def _reset_peak_rss():
+    """Start measuring the peak RSS afresh, if the system allows it.
+
+    Returns True if it did. Otherwise the peak is the process's lifetime
+    peak (ru_maxrss).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def _peak_rss():
+    """Return the peak RSS of this process, in bytes."""
+    try:
+        with open('/proc/self/status', 'r') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cpu():
+    """Return the CPU (user + system) seconds used by this process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Measurement(object):
+    """Measure the cost of a block of code.
+
+        with Measurement('downscale') as measurement:
+            ...
+        measurement.record  # {'name': 'downscale', 'wall_seconds': ...}
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = _cpu()
+        self._io = _io()
+        return self
+
+    def __exit__(self, *exc_info):
+        read, written = _io()
+        self.record = {
+            'name': self.name,
+            'wall_seconds': time.time() - self._wall,
+            'cpu_seconds': _cpu() - self._cpu,
+            'peak_rss_mb': _peak_rss() / 2.0**20,
+            'bytes_read': None if read is None else read - self._io[0],
+            'bytes_written':
+                None if written is None else written - self._io[1],
+        }
+
+
+def profiled(func):
+    """Decorator: record the cost of every call to func."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with Measurement(func.__name__) as measurement:
+            result = func(*args, **kwargs)
+        _calls.append(measurement.record)
+        return result
+    return wrapper
+
+
+def rows_read(n_rows):
+    """Count data rows read by the stage that is running."""
+    _rows_in[0] += n_rows
+
+
+def rows_written(n_rows):
+    """Count data rows written by the stage that is running."""
+    _rows_out[0] += n_rows
+
+
+def _safe_name(name):
+    """Return a stage name that can be used as a file name."""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+def run_profiled(name, func, args, options=(), profile_dir=PROFILE_DIR):
+    """Run func(*args) and measure it.
+
+    Returns (result, record): the record also holds the @profiled calls
+    made during the run, and whatever the options asked for.
+    """
+    del _calls[:]
+    _rows_in[0] = 0
+    _rows_out[0] = 0
+    _reset_peak_rss()
+    if 'memory' in options and tracemalloc is not None:
+        tracemalloc.start()
+    profile = cProfile.Profile() if 'cprofile' in options else None
+    with Measurement(name) as measurement:
+        if profile is None:
+            result = func(*args)
+        else:
+            result = profile.runcall(func, *args)
+    record = measurement.record
+    record['calls'] = list(_calls)
+    record['rows_in'] = _rows_in[0]
+    record['rows_out'] = _rows_out[0]
+    if profile is not None:
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        profile_file = os.path.join(profile_dir, _safe_name(name) + '.prof')
+        profile.dump_stats(profile_file)
+        record['cprofile'] = profile_file
+    if 'memory' in options and tracemalloc is not None:
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        tracemalloc.stop()
+        record['traced_peak_mb'] = peak / 2.0**20
+        record['top_allocations'] = [
+            {'line': str(stat.traceback), 'mb': stat.size / 2.0**20}
+            for stat in top]
+    return result, record
+
+
+def file_bytes(files):
+    """Return the bytes in a list of files, leaving out missing ones."""
+    return sum(os.path.getsize(name) for name in files
+               if os.path.isfile(name))
+
+
+def write_report(report, report_file=REPORT_FILE):
+    """Write a run's report as JSON."""
+    tmp_file = report_file + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(report, outfile, indent=1, sort_keys=True)
+    os.rename(tmp_file, report_file)
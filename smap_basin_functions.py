@@ -20,7 +20,16 @@ Hilary Wayland
 """
 
 import csv
-import time
+
+from compression import compressed_name, find_file, open_file
+from csi_time import compact_date
+from profiling import profiled
+from smap_writer import DESCRIPTION, NAN, banner, float_column, \
+    format_column, read_blocks, write_preamble, write_rows
+from toa5_index import last_timestamp
+
+# What we write when we have no value:
+MISSING = str(-8888)
 
 
 def make_row(line):
@@ -46,8 +55,19 @@ def make_header():
 
 
 # DATE = datetime.date.today().__str__()
-def make_smap_data_for_basin_sites():
-    """Make SMAP data files for each basin site."""
+@profiled
+def make_smap_data_for_basin_sites(site_names=None, compression=None,
+                                   date=None):
+    """Make SMAP data files for each basin site.
+
+    param: site_names - Only make files for these sites (e.g. ['Open']).
+        By default files are made for every site.
+    param: compression - Write the files compressed: 'gz', 'bz2' or 'xz'
+        (see compression.py). The smapdata files may be compressed either
+        way.
+    param: date - The date ('YYYYMMDD') to name the files by. By default
+        that of the last record of each smapdata file.
+    """
     SITE = '2401'
 
     sites = {
@@ -77,79 +97,49 @@ def make_smap_data_for_basin_sites():
         }
     }
     files_for_upload = []
-    for site in sites.keys():
-        # Determine the year, month, and day based on last line of infile:
-        with open(sites[site]['SM_FILE'], 'rb') as infile:
-            import shlex
-            # Determine the year, month, and day based on last line of infile:
-            last_line = infile.readlines()[-1:]
-            # assume timestamp is the first column
-            # use shlex to get rid of double quotes in time stamp string
-            time_stamp = shlex.split(last_line[0])[0].split()[0]
-            SITE_FILE = SITE + sites[site]['num'] + '_' + ''.join(
-                time_stamp[:10].split('-')) + '.txt'
+    for site in site_names or sites.keys():
+        SM_FILE = find_file(sites[site]['SM_FILE'])
+        # Determine the year, month, and day based on last line of infile.
+        # Only the end of the file is read to find it.
+        site_date = date or compact_date(
+            last_timestamp(SM_FILE, header_lines=1))
+        SITE_FILE = compressed_name(
+            SITE + sites[site]['num'] + '_' + site_date + '.txt',
+            compression)
         files_for_upload.append(SITE_FILE)
-        sitefile = open(SITE_FILE, 'wb')
-        infile = open(sites[site]['SM_FILE'], 'rb')
-        reader = csv.reader(infile)
-        writer = csv.writer(sitefile)
-        # fileinfo = next(reader, None)  # skip the first line
-        fieldnames = next(reader, None)  # These are the headers
-        # units = next(reader, None)  # Units of observation
-        # sample = next(reader, None)  # Method of data sampling
-        reader_dict = csv.DictReader(infile, fieldnames=fieldnames)
-        writer.writerow(make_header())
-        depths = 'Depths: 005=0.05m/010=0.10m/020=0.20m/030=0.30m/100=1.00m'
-        descp = ['Time Zone: UTC+3', depths]
-        writer.writerow(descp)
-        writer.writerow(
-            [sites[site]['header'], time.strftime(
-                "%a, %d %b %Y %H:%M GMT", time.gmtime())])
-
-        for line in reader_dict:
-            row = []
-
-            TIMESTAMP = format(str(line['TIMESTAMP']))
-            row.extend([TIMESTAMP])
-
-            t_air = str('{0:.1f}').format(float(line['t_hmp_Avg']))
-            if t_air is "NAN":
-                t_air == str(-8888)
-            prec = str('{0:.1f}').format(float(line['Rain_mm_Tot']))
-            if prec is "NAN":
-                prec == str(-8888)
-            row.extend([t_air, prec])
-
-            row.insert(0, SITE + sites[site]['num'])
-            # Add soil moisture data
-            if line['VW_05cm_Avg'] == 'NAN':
-                SM005 = str(-8888)
-            else:
-                SM005 = str('{0:.3f}').format(float(line['VW_05cm_Avg']))
-
-            if line['VW_20cm_Avg'] == 'NAN':
-                SM020 = str(-8888)
-            else:
-                try:
-                    SM020 = str('{0:.3f}').format(float(line['VW_20cm_Avg']))
-                except:
-                    SM020 = str(-8888)
-
-            if line['Temp_05cm_Avg'] == 'NAN':
-                TS005 = str(-8888)
-            else:
-                try:
-                    TS005 = str('{0:.1f}').format(float(line['Temp_05cm_Avg']))
-                except:
-                    TS005 = str(-8888)
-
-            if line['Temp_20cm_Avg'] == 'NAN':
-                TS020 = str(-8888)
-            else:
-                try:
-                    TS020 = str('{0:.1f}').format(float(line['Temp_20cm_Avg']))
-                except:
-                    TS020 = str(-8888)
-            row.extend([SM005, TS005, SM020, TS020])
-            writer.writerow(row)
+        with open_file(SM_FILE, 'rb') as infile, \
+                open_file(SITE_FILE, 'wb') as sitefile:
+            fieldnames = next(csv.reader(infile), None)  # The headers
+            write_preamble(sitefile, [
+                make_header(), DESCRIPTION, banner(sites[site]['header'])])
+            write_site_rows(
+                infile, sitefile, SITE + sites[site]['num'], fieldnames)
     return files_for_upload
+
+
+def write_site_rows(infile, sitefile, site_id, fieldnames):
+    """Write the rows of a basin site's SMAP file, a block at a time.
+
+    Missing soil moisture and temperatures are written as -8888. Soil
+    moisture at 20 cm and the temperatures are also -8888 when they are
+    not numbers.
+    """
+    column = dict((name, i) for i, name in enumerate(fieldnames))
+    for block in read_blocks(infile, len(fieldnames)):
+        timestamps = block[column['TIMESTAMP']]
+        n_rows = len(timestamps)
+        columns = [[site_id] * n_rows, timestamps]
+        for var in ['t_hmp_Avg', 'Rain_mm_Tot']:
+            columns.append(format_column(
+                float_column(block[column[var]]), '.1f'))
+        # Add soil moisture data
+        columns.append(format_column(
+            float_column(block[column['VW_05cm_Avg']]), '.3f',
+            MISSING))
+        for var, spec in [('Temp_05cm_Avg', '.1f'),
+                          ('VW_20cm_Avg', '.3f'),
+                          ('Temp_20cm_Avg', '.1f')]:
+            columns.append(format_column(
+                float_column(block[column[var]], empty=NAN, invalid=NAN),
+                spec, MISSING))
+        write_rows(sitefile, columns)
@@ -29,7 +29,31 @@ K. Caylor, March 2016:
 
 """
 import csv
-import time
+import json
+import os
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the *_array functions
+    np = None
+
+from compression import compressed_name, find_file, open_file
+from csi_time import compact_date
+from profiling import profiled
+from smap_writer import DESCRIPTION, NAN, banner, float_column, \
+    format_column, read_blocks, write_preamble, write_rows
+from toa5_index import last_timestamp
+
+# Coefficients for turning a probe period into VWC. The period is corrected
+# to the reference temperature with the quadratic temp_coefs, and the VWC
+# is the quadratic vwc_coefs of the corrected period. Other probes can be
+# given their own coefficients in CALIBRATION_FILE (see load_calibrations).
+DEFAULT_CALIBRATION = {
+    'reference_temp': 20,
+    'temp_coefs': [0.526, -0.052, 0.00136],
+    'vwc_coefs': [-0.0663, -0.0063, 0.0007],
+}
+CALIBRATION_FILE = 'calibrations.json'
 
 
 def make_row(line):
@@ -61,18 +85,76 @@ def make_header():
     return header
 
 
-def correct_period(period_uncorr, temp):
+def load_calibrations(calibration_file=CALIBRATION_FILE):
+    """Load per-sensor calibration coefficients.
+
+    The file is JSON, mapping period variable names (e.g. "PA005cmTree_Avg")
+    to dicts with any of the keys of DEFAULT_CALIBRATION. A "default" entry
+    replaces DEFAULT_CALIBRATION for every sensor without its own entry.
+    Returns an empty dict if the file does not exist.
+    """
+    if not os.path.exists(calibration_file):
+        return {}
+    with open(calibration_file, 'r') as infile:
+        return json.load(infile)
+
+
+def get_calibration(calibrations, sensor):
+    """Return the full set of coefficients to use for a sensor."""
+    calibration = dict(DEFAULT_CALIBRATION)
+    calibration.update(calibrations.get('default', {}))
+    calibration.update(calibrations.get(sensor, {}))
+    return calibration
+
+
+def correct_period(period_uncorr, temp, calibration=DEFAULT_CALIBRATION):
     """Correct period."""
-    return float(period_uncorr) + (20 - float(temp)) *\
-        (0.526 - 0.052 * float(period_uncorr) + 0.00136 *
+    a, b, c = calibration['temp_coefs']
+    return float(period_uncorr) + \
+        (calibration['reference_temp'] - float(temp)) *\
+        (a + b * float(period_uncorr) + c *
             float(period_uncorr)**2)
 
 
-def calc_vwc(period, temp=None):
+def calc_vwc(period, temp=None, calibration=DEFAULT_CALIBRATION):
     """Calculate VWC."""
     if temp > -8888:
-        period = correct_period(period, temp)
-    return -0.0663 - 0.0063 * float(period) + (0.0007 * (float(period)**2))
+        period = correct_period(period, temp, calibration)
+    a, b, c = calibration['vwc_coefs']
+    return a + b * float(period) + (c * (float(period)**2))
+
+
+def correct_period_array(periods, temps, calibration=DEFAULT_CALIBRATION):
+    """Correct a whole column of periods for temperature at once.
+
+    Periods with a missing temperature (-8888 or NaN) are left as they are.
+    """
+    periods = np.asarray(periods, dtype=np.float64)
+    temps = np.asarray(temps, dtype=np.float64)
+    a, b, c = calibration['temp_coefs']
+    # np.power, unlike **, uses pow() just like the scalar functions do.
+    corrected = periods + (calibration['reference_temp'] - temps) * (
+        a + b * periods + c * np.power(periods, 2))
+    with np.errstate(invalid='ignore'):
+        return np.where(temps > -8888, corrected, periods)
+
+
+def calc_vwc_array(periods, temps=None, calibration=DEFAULT_CALIBRATION):
+    """Calculate VWC for a whole column of periods at once.
+
+    param: periods - Probe periods. Missing periods are NaN.
+    param: temps - Soil temperatures for each period, or None if there
+        is no temperature sensor. Missing values are -8888 or NaN.
+
+    Returns the VWC for each period, with -8888 where the period is
+    missing, just like calc_vwc does for one 'NAN' period at a time.
+    """
+    periods = np.asarray(periods, dtype=np.float64)
+    if temps is not None:
+        periods = correct_period_array(periods, temps, calibration)
+    a, b, c = calibration['vwc_coefs']
+    vwc = a + b * periods + (c * np.power(periods, 2))
+    return np.where(np.isnan(periods), -8888, vwc)
 
 
 def make_var_name(var, depth, site):
@@ -92,11 +174,82 @@ def make_var_name(var, depth, site):
             return None
 
 
-def make_smap_data_for_tower_sites():
-    """Create the smap file from the tower site smapdata file."""
+# Depths observed at every tower site:
+OBS_DEPTHS = ['005', '010', '020', '030', '100']
+
+# Used in a site plan for depths that have no temperature sensor:
+NO_TEMPERATURE = None
+
+# What we write when we have no value for a depth:
+MISSING = str('{0:.1f}').format(-8888)
+
+
+def compile_site_plan(
+        fieldnames,
+        sites=('Tree', 'Grass', 'Open', 'Riparian'),
+        obs_depths=OBS_DEPTHS):
+    """Work out where every site's data lives in a smapdata row.
+
+    param: fieldnames - The variable names from the smapdata header.
+    param: sites - The tower sites to plan for.
+    param: obs_depths - The depths observed at every site.
+
+    Returns a list of (site, depth, period column, temperature column)
+    tuples, in site and then depth order. The temperature column is
+    NO_TEMPERATURE when the site has no sensor at that depth (or the
+    sensor is not in the file). A KeyError is raised if a period column
+    is missing.
+    """
+    plan = []
+    for site in sites:
+        for obs_depth in obs_depths:
+            pa = make_var_name('PA', obs_depth, site)
+            tsoil = make_var_name('Tsoil', obs_depth, site)
+            if pa not in fieldnames:
+                raise KeyError(pa)
+            if tsoil in fieldnames:
+                tsoil_col = fieldnames.index(tsoil)
+            else:
+                tsoil_col = NO_TEMPERATURE
+            plan.append((site, obs_depth, fieldnames.index(pa), tsoil_col))
+    return plan
+
+
+def _missing_column(n_rows):
+    """Return a column of n_rows missing values, as text."""
+    return [MISSING] * n_rows
+
+
+def _vwc_column(periods, temps, calibration):
+    """Return the VWC of a column of periods (-8888 where NaN).
+
+    param: temps - The soil temperatures, or None if there is no sensor.
+    """
+    if np is not None:
+        return calc_vwc_array(periods, temps, calibration).tolist()
+    if temps is None:
+        temps = [None] * len(periods)
+    return [
+        -8888 if period != period else calc_vwc(period, temp, calibration)
+        for period, temp in zip(periods, temps)]
+
+
+@profiled
+def make_smap_data_for_tower_sites(calibrations=None, compression=None,
+                                   date=None):
+    """Create the smap file from the tower site smapdata file.
+
+    param: calibrations - Per-sensor calibration coefficients (see
+        load_calibrations). By default they are read from CALIBRATION_FILE.
+    param: compression - Write the files compressed: 'gz', 'bz2' or 'xz'
+        (see compression.py). The smapdata file may be compressed either
+        way.
+    param: date - The date ('YYYYMMDD') to name the files by. By default
+        that of the last record of the smapdata file.
+    """
     # SITE INFORMATION
     SITE = '2401'   # SMAP site #
-    SM_FILE = 'smapdata'
+    SM_FILE = find_file('smapdata')
 
     """
     Station information:
@@ -119,142 +272,110 @@ def make_smap_data_for_tower_sites():
 
     """
 
-    # Determine the year, month, and day based on last line of infile:
-    with open(SM_FILE, 'rb') as infile:
-        import shlex
-        # Determine the year, month, and day based on last line of infile:
-        last_line = infile.readlines()[-1:]
-        # assume timestamp is the first column
-        # use shlex to get rid of double quotes in time stamp string
-        ts = shlex.split(last_line[0])[0].split()[0]
-
-    TREE_FILE = SITE + '001' + '_' + ''.join(ts[:10].split('-')) + '.txt'
-    GRASS_FILE = SITE + '002' + '_' + ''.join(ts[:10].split('-')) + '.txt'
-    OPEN_FILE = SITE + '003' + '_' + ''.join(ts[:10].split('-')) + '.txt'
-    RIP_FILE = SITE + '004' + '_' + ''.join(ts[:10].split('-')) + '.txt'
-
-    infile = open(SM_FILE, 'rb')
-    treefile = open(TREE_FILE, 'wb')
-    grassfile = open(GRASS_FILE, 'wb')
-    openfile = open(OPEN_FILE, 'wb')
-    ripfile = open(RIP_FILE, 'wb')
-
-    reader = csv.reader(infile)
-    t_writer = csv.writer(treefile)
-    g_writer = csv.writer(grassfile)
-    o_writer = csv.writer(openfile)
-    r_writer = csv.writer(ripfile)
-
-    fieldnames = next(reader, None)  # These are the headers
-    reader_dict = csv.DictReader(infile, fieldnames=fieldnames)
-
-    # Write the header
-    t_writer.writerow(
-        ['Mpala Research Center, Soil Moisture Station 1 (Tree)',
-            time.strftime("%a, %d %b %Y %H:%M GMT", time.gmtime())]
-    )
-    g_writer.writerow(
-        ['Mpala Research Center, Soil Moisture Station 2 (Grass)',
-            time.strftime("%a, %d %b %Y %H:%M GMT", time.gmtime())]
-    )
-    o_writer.writerow(
-        ['Mpala Research Center, Soil Moisture Station 3 (Open)',
-            time.strftime("%a, %d %b %Y %H:%M GMT", time.gmtime())]
-    )
-    r_writer.writerow(
-        ['Mpala Research Center, Soil Moisture Station 4 (Riparian)',
-            time.strftime("%a, %d %b %Y %H:%M GMT", time.gmtime())]
-    )
-
-    # All SMAP files have the same SMAP header:
-    header = make_header()
-    t_writer.writerow(header)
-    g_writer.writerow(header)
-    o_writer.writerow(header)
-    r_writer.writerow(header)
-
-    depths = 'Depths: 005=0.05m/010=0.10m/020=0.20m/030=0.30m/100=1.00m'
-    descp = ['Time Zone: UTC+3', depths]
-    t_writer.writerow(descp)
-    g_writer.writerow(descp)
-    o_writer.writerow(descp)
-    r_writer.writerow(descp)
-
-    obs_depths = ['005', '010', '020', '030', '100']
-
-    sites = {
-        'Tree': {
-            'num': '001',
-            'writer': t_writer
-        },
-        'Grass': {
-            'num': '002',
-            'writer': g_writer
-        },
-        'Open': {
-            'num': '003',
-            'writer': o_writer
-        },
-        'Riparian': {
-            'num': '004',
-            'writer': r_writer
+    # Determine the year, month, and day based on last line of infile.
+    # Only the end of the file is read to find it.
+    if date is None:
+        date = compact_date(last_timestamp(SM_FILE, header_lines=1))
+
+    TREE_FILE = SITE + '001' + '_' + date + '.txt'
+    GRASS_FILE = SITE + '002' + '_' + date + '.txt'
+    OPEN_FILE = SITE + '003' + '_' + date + '.txt'
+    RIP_FILE = SITE + '004' + '_' + date + '.txt'
+
+    TREE_FILE, GRASS_FILE, OPEN_FILE, RIP_FILE = [
+        compressed_name(name, compression)
+        for name in [TREE_FILE, GRASS_FILE, OPEN_FILE, RIP_FILE]]
+
+    station_files = [
+        (TREE_FILE, 'Mpala Research Center, Soil Moisture Station 1 (Tree)'),
+        (GRASS_FILE,
+         'Mpala Research Center, Soil Moisture Station 2 (Grass)'),
+        (OPEN_FILE, 'Mpala Research Center, Soil Moisture Station 3 (Open)'),
+        (RIP_FILE,
+         'Mpala Research Center, Soil Moisture Station 4 (Riparian)'),
+    ]
+    infile = open_file(SM_FILE, 'rb')
+    out_files = [open_file(name, 'wb') for name, _ in station_files]
+    try:
+        fieldnames = next(csv.reader(infile), None)  # These are the headers
+
+        # Write the header. All SMAP files have the same SMAP header:
+        for out_file, (_, station) in zip(out_files, station_files):
+            write_preamble(
+                out_file, [banner(station), make_header(), DESCRIPTION])
+
+        treefile, grassfile, openfile, ripfile = out_files
+        sites = {
+            'Tree': {
+                'num': '001',
+                'file': treefile
+            },
+            'Grass': {
+                'num': '002',
+                'file': grassfile
+            },
+            'Open': {
+                'num': '003',
+                'file': openfile
+            },
+            'Riparian': {
+                'num': '004',
+                'file': ripfile
+            }
         }
-    }
 
-    try:
-        # Iterate through all the lines in the input file.
-        for line in reader_dict:
-            # line = next(reader_dict)
-            row = []
-
-            TIMESTAMP = format(str(line['TIMESTAMP']))
-            row.extend([TIMESTAMP])
-
-            t_air = line.get('t_hmp_Avg') or -8888
-            if "NAN" in t_air.upper():
-                t_air = -8888
-            rain = line.get('rainfall_Tot') or -8888
-            if "NAN" in rain.upper():
-                rain = -8888
-            t_air = str('{0:.1f}').format(float(t_air))
-            prec = str('{0:.1f}').format(float(rain))
-            row.extend([t_air, prec])
-
-            for site in sites.keys():
-                # Create a temporary site row for this site
-                site_row = list(row)
-                # Add the site number to this site row
-                site_row.insert(0, SITE + sites[site]['num'])
-                # iterate through all the depths for this site
+        # Work out the columns for every site and depth once, rather than
+        # building and looking up the variable names on every line.
+        if calibrations is None:
+            calibrations = load_calibrations()
+        plan = compile_site_plan(fieldnames, sites.keys())
+        site_plans = []
+        for site in sites.keys():
+            site_plans.append((
+                sites[site]['file'],
+                SITE + sites[site]['num'],
+                [(pa, tsoil, get_calibration(calibrations, fieldnames[pa]))
+                 for s, _, pa, tsoil in plan if s == site]))
+        ts_col = fieldnames.index('TIMESTAMP')
+        t_air_col = rain_col = None
+        if 't_hmp_Avg' in fieldnames:
+            t_air_col = fieldnames.index('t_hmp_Avg')
+        if 'rainfall_Tot' in fieldnames:
+            rain_col = fieldnames.index('rainfall_Tot')
+
+        # Work through the input file a block of lines at a time.
+        for block in read_blocks(infile, len(fieldnames)):
+            n_rows = len(block[ts_col])
+            row = [block[ts_col]]
+            for column in [t_air_col, rain_col]:
+                row.append(_missing_column(n_rows) if column is None else
+                           format_column(float_column(
+                               block[column], empty=NAN), '.1f',
+                               MISSING))
+            for out_file, site_id, columns in site_plans:
+                # Create a site's columns, starting with the site number
+                site_columns = [[site_id] * n_rows] + row
                 # NOTE: we assume all sites have the same depths
-                for obs_depth in obs_depths:
-                    vwc = make_var_name('VW', obs_depth, site)
-                    pa = make_var_name('PA', obs_depth, site)
-                    tsoil = make_var_name('Tsoil', obs_depth, site)
-                    soil_moisture = None
+                for pa_col, tsoil_col, calibration in columns:
                     soil_temperature = None
-
-                    if tsoil:  # Get the current value of temp if we have it:
-                        soil_temperature = float(line.get(tsoil) or -8888)
-                    # Check to see if we have period data for this depth:
-                    if line[pa] == 'NAN':  # If not, then use a -8888
-                        soil_moisture = -8888
-                    else:  # If we do, then caluclate the corrected VWC:
-                        soil_moisture = calc_vwc(
-                            float(line[pa]),
-                            soil_temperature)
+                    if tsoil_col is not NO_TEMPERATURE:
+                        soil_temperature = float_column(
+                            block[tsoil_col], empty=-8888.0)
+                    # Missing periods give a -8888, the rest the
+                    # corrected VWC:
+                    site_columns.append(format_column(_vwc_column(
+                        float_column(block[pa_col]), soil_temperature,
+                        calibration), '.1f'))
                     # If we don't have a temp value for this depth, use -8888:
                     if soil_temperature is None:
-                        soil_temperature = -8888
-                    site_row.extend([
-                        str('{0:.1f}').format(soil_moisture),
-                        str('{0:.1f}').format(soil_temperature)])
+                        site_columns.append(_missing_column(n_rows))
+                    else:
+                        site_columns.append(
+                            format_column(soil_temperature, '.1f'))
                 # Now that we are done, we should have everything we need:
-                sites[site]['writer'].writerow(site_row)
+                write_rows(out_file, site_columns)
     finally:
         infile.close()
-        treefile.close()
-        grassfile.close()
-        openfile.close()
-        ripfile.close()
+        for out_file in out_files:
+            out_file.close()
     return [TREE_FILE, GRASS_FILE, OPEN_FILE, RIP_FILE]
@@ -0,0 +1,131 @@
+"""Write the SMAP upload files a block of rows at a time.
+
+The SMAP writers (smap_tower_functions.py and smap_basin_functions.py) read
+an smapdata file in blocks of BLOCK_ROWS rows. Each block is turned into
+columns: lists of numbers parsed with float_column, or the text itself for
+the timestamps. Every column is then formatted with one format spec
+(format_column), and missing values (NaN) are replaced by the -8888
+sentinel for the whole column at once. write_rows joins a block of
+columns into rows and writes it with a single call.
+
+The header lines of each file (column names, Time Zone/depths and the
+station banner) are still written with csv, so their quoting is the same
+as it always was. Data values never need quoting, so the rows are joined
+directly, with the same line endings as csv.writer ('\\r\\n').
+"""
+import csv
+import time
+from itertools import islice
+
+from profiling import rows_read, rows_written
+
+try:
+    import numpy as np
+except ImportError:  # without numpy missing values are found one by one
+    np = None
+
+# Rows formatted and written at a time.
+BLOCK_ROWS = 10000
+
+# A missing value, before formatting.
+NAN = float('nan')
+
+# The line ending used by csv.writer.
+LINE_END = '\r\n'
+
+DEPTHS = 'Depths: 005=0.05m/010=0.10m/020=0.20m/030=0.30m/100=1.00m'
+DESCRIPTION = ['Time Zone: UTC+3', DEPTHS]
+
+
+def banner(station):
+    """Return the banner row of a SMAP file: the station and the time now."""
+    return [station, time.strftime("%a, %d %b %Y %H:%M GMT", time.gmtime())]
+
+
+def write_preamble(out_file, rows):
+    """Write the header rows of a SMAP file (with csv quoting)."""
+    csv.writer(out_file).writerows(rows)
+
+
+def read_blocks(in_file, n_fields, block_rows=BLOCK_ROWS):
+    """Yield the rest of a csv file a block of rows at a time.
+
+    param: n_fields - The number of fields in a full row. Short rows (e.g.
+        no flux data) are padded with None.
+
+    Each block is a list of columns, each a tuple of text values.
+    Blank rows are skipped.
+    """
+    reader = csv.reader(in_file)
+    while True:
+        rows = list(islice(reader, block_rows))
+        if not rows:
+            return
+        rows = [
+            row if len(row) >= n_fields else row + [None] * (
+                n_fields - len(row))
+            for row in rows if row]
+        rows_read(len(rows))
+        if rows:
+            yield zip(*rows)
+
+
+def float_column(texts, empty=None, invalid=None):
+    """Parse a column of text into a list of floats.
+
+    "NAN" becomes NaN, as float() makes it.
+
+    param: empty - The value of '' and None. By default they are invalid.
+    param: invalid - The value of anything else that is not a number. By
+        default a ValueError (or TypeError) is raised, as float() does.
+    """
+    try:
+        return map(float, texts)
+    except (TypeError, ValueError):
+        pass
+    values = []
+    for text in texts:
+        if not text and empty is not None:
+            values.append(empty)
+            continue
+        try:
+            values.append(float(text))
+        except (TypeError, ValueError):
+            if invalid is None:
+                raise
+            values.append(invalid)
+    return values
+
+
+def missing_rows(values):
+    """Return the positions of the NaNs in a column of numbers."""
+    if np is not None:
+        return np.flatnonzero(
+            np.isnan(np.asarray(values, dtype=np.float64))).tolist()
+    return [i for i, value in enumerate(values) if value != value]
+
+
+def format_column(values, spec, missing=None):
+    """Format a column of numbers as text, as format(value, spec) would.
+
+    param: spec - A fixed-point format spec, e.g. '.3f'.
+    param: missing - The text to write for NaN (e.g. '-8888'). If None,
+        NaN is formatted like any other value ('nan').
+    """
+    # % is quicker than format(), and the same except that it switches to
+    # exponent notation for numbers of 1e50 and more.
+    texts = map(('%' + spec).__mod__, values)
+    if 'e' in ''.join(texts):
+        texts = map(format, values, [spec] * len(values))
+    if missing is not None:
+        for i in missing_rows(values):
+            texts[i] = missing
+    return texts
+
+
+def write_rows(out_file, columns):
+    """Write equal-length columns of text as comma separated rows."""
+    rows = map(','.join, zip(*columns))
+    rows_written(len(rows))
+    if rows:
+        out_file.write(LINE_END.join(rows) + LINE_END)
@@ -0,0 +1,251 @@
+"""Run a pipeline as a graph of stages, like make.
+
+Every stage declares the files it reads (inputs) and writes (outputs):
+
+    stages = [
+        stage('join tower', write_joined, ('tenMinuteTable',),
+              inputs=[soil_moisture_file, upper_file],
+              outputs=['tenMinuteTable']),
+        stage('downscale tower', downscale, ('tenMinuteTable', ...),
+              inputs=['tenMinuteTable'], outputs=['sixtyMinuteTable']),
+        ...
+    ]
+    outcomes = run_stages(stages, workers=4)
+
+A stage depends on the stages that write its inputs, and on any stage
+named in its `after` list. A stage is run when:
+
+ - one of its outputs is missing, or older than one of its inputs, or
+ - a stage it depends on was run in this build, or
+ - it has no outputs at all (e.g. upload), or the build is forced.
+
+Otherwise it is up to date and skipped. If a stage fails, the outputs it
+wrote are removed (so that a half-written file never looks up to date)
+and the stages that depend on it are not run, unless they are declared
+with despite_failures; everything else still is. Running again after
+fixing the problem picks up where the failed build stopped.
+
+Inputs and outputs may also be given as a function returning the list
+of files, for files whose names are only known once earlier stages have
+run (e.g. the dated SMAP files). Stages run in parallel through a
+parallel.JobPool, each started as soon as the stages it depends on have
+finished.
+
+Every stage that runs is measured (see profiling.py); give a report_file
+to keep the measurements.
+"""
+import os
+import time
+from datetime import datetime
+
+from parallel import JobPool, default_workers
+from profiling import PROFILE_DIR, file_bytes, run_profiled, write_report
+
+# Outcomes of a stage.
+RAN = 'ran'
+UP_TO_DATE = 'up to date'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+def stage(name, func, args=(), inputs=(), outputs=(), after=(),
+          despite_failures=False):
+    """Declare a stage.
+
+    param: name - Unique name of the stage.
+    param: func, args - The stage runs func(*args). func must be a module
+        level function so that it can be run in a worker process.
+    param: inputs, outputs - Lists of files (or functions returning them).
+    param: after - Names of stages that must finish first even though
+        they write none of this stage's inputs.
+    param: despite_failures - Run once the stages it depends on have
+        finished, even if some of them failed (e.g. to upload whatever
+        the other stations made).
+    """
+    return {
+        'name': name,
+        'func': func,
+        'args': tuple(args),
+        'inputs': inputs,
+        'outputs': outputs,
+        'after': list(after),
+        'despite_failures': despite_failures,
+    }
+
+
+def _files(files):
+    """Return a stage's inputs or outputs as a list."""
+    if callable(files):
+        return list(files())
+    return list(files)
+
+
+def dependencies(stages):
+    """Return a dict of stage name -> names of the stages it depends on.
+
+    Only static (list) outputs are used to find who writes an input.
+    """
+    writers = {}
+    for this_stage in stages:
+        if not callable(this_stage['outputs']):
+            for output in this_stage['outputs']:
+                writers[output] = this_stage['name']
+    names = set(this_stage['name'] for this_stage in stages)
+    deps = {}
+    for this_stage in stages:
+        needs = set(this_stage['after'])
+        if not callable(this_stage['inputs']):
+            needs.update(
+                writers[i] for i in this_stage['inputs'] if i in writers)
+        needs.discard(this_stage['name'])
+        unknown = needs - names
+        if unknown:
+            raise ValueError("Stage {0} is after unknown stages: {1}".format(
+                this_stage['name'], ', '.join(sorted(unknown))))
+        deps[this_stage['name']] = needs
+    return deps
+
+
+def out_of_date(this_stage):
+    """Return True if a stage's outputs are missing or older than its inputs.
+
+    A stage with no outputs is always out of date. Inputs that do not
+    exist are ignored here; the stage will fail when it is run.
+    """
+    outputs = _files(this_stage['outputs'])
+    if not outputs:
+        return True
+    if not all(os.path.exists(output) for output in outputs):
+        return True
+    oldest = min(os.path.getmtime(output) for output in outputs)
+    inputs = [i for i in _files(this_stage['inputs']) if os.path.exists(i)]
+    return any(os.path.getmtime(i) > oldest for i in inputs)
+
+
+def _remove_new_outputs(this_stage, since):
+    """Remove the outputs of a failed stage that it (re)wrote."""
+    try:
+        outputs = _files(this_stage['outputs'])
+    except Exception:
+        return
+    for output in outputs:
+        if os.path.exists(output) and os.path.getmtime(output) >= since:
+            os.remove(output)
+
+
+def _needed(stages, deps, targets):
+    """Return the names of the target stages and everything they need."""
+    if targets is None:
+        return set(this_stage['name'] for this_stage in stages)
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in deps:
+            raise ValueError("Unknown stage: {0}".format(name))
+        if name not in needed:
+            needed.add(name)
+            todo.extend(deps[name])
+    return needed
+
+
+def _stage_record(this_stage, outcome, record):
+    """Return the report entry of a stage that ran."""
+    entry = dict(record, stage=this_stage['name'], outcome=outcome)
+    del entry['name']
+    try:
+        inputs = _files(this_stage['inputs'])
+        outputs = _files(this_stage['outputs'])
+    except Exception:
+        inputs = outputs = []
+    # rows_in and rows_out were counted by the stage itself (see
+    # profiling.rows_read): reading every file in full would cost more
+    # than the stage.
+    entry['input_bytes'] = file_bytes(inputs)
+    entry['output_bytes'] = file_bytes(outputs)
+    return entry
+
+
+def run_stages(stages, workers=None, targets=None, force=False,
+               report_file=None, profile=()):
+    """Run every stage that is out of date, in dependency order.
+
+    param: workers - Number of stages to run at once (see JobPool).
+    param: targets - Names of the stages wanted; they and the stages they
+        depend on are considered. None means every stage.
+    param: force - Run every stage whether or not it is up to date.
+    param: report_file - Write the measurements of the run here (JSON).
+    param: profile - Extra profiling options (see profiling.py); cProfile
+        files are saved in PROFILE_DIR next to report_file.
+
+    Returns a dict of stage name -> (outcome, value): outcome is RAN,
+    UP_TO_DATE, FAILED or BLOCKED; value is what the stage returned, or
+    the traceback if it failed. A line is printed for every stage.
+    """
+    deps = dependencies(stages)
+    needed = _needed(stages, deps, targets)
+    pending = [s for s in stages if s['name'] in needed]
+    outcomes = {}
+    records = {}
+    profile_dir = os.path.join(
+        os.path.dirname(report_file or '.'), PROFILE_DIR)
+    started_run = datetime.utcnow()
+    by_name = dict((s['name'], s) for s in pending)
+    started = {}
+    pool = JobPool(min(workers or default_workers(), len(pending)))
+    try:
+        while pending or pool.running:
+            # Start (or settle) every stage whose dependencies have all
+            # finished; that may make others ready, so go round again.
+            ready = [
+                s for s in pending
+                if all(d in outcomes for d in deps[s['name']])]
+            pending = [s for s in pending if s not in ready]
+            for this_stage in ready:
+                name = this_stage['name']
+                upstream = [outcomes[d][0] for d in deps[name]]
+                if (FAILED in upstream or BLOCKED in upstream) and \
+                        not this_stage['despite_failures']:
+                    outcomes[name] = (BLOCKED, None)
+                elif force or RAN in upstream or out_of_date(this_stage):
+                    # Allow for coarse file timestamps.
+                    started[name] = time.time() - 1
+                    pool.submit(name, run_profiled, (
+                        name, this_stage['func'], this_stage['args'],
+                        profile, profile_dir))
+                else:
+                    outcomes[name] = (UP_TO_DATE, None)
+            if ready:
+                continue
+            if not pool.running:
+                raise ValueError("Stages depend on each other: {0}".format(
+                    ', '.join(s['name'] for s in pending)))
+            name, result, error = pool.next_done()
+            if error is None:
+                value, record = result
+                outcomes[name] = (RAN, value)
+                # Measure the outputs now: later stages may remove them.
+                records[name] = _stage_record(by_name[name], RAN, record)
+            else:
+                outcomes[name] = (FAILED, error)
+                _remove_new_outputs(by_name[name], started[name])
+    finally:
+        pool.close()
+
+    report = {
+        'started': started_run.isoformat(),
+        'wall_seconds':
+            (datetime.utcnow() - started_run).total_seconds(),
+        'profile': sorted(profile),
+        'stages': [],
+    }
+    for this_stage in stages:
+        name = this_stage['name']
+        if name in outcomes:
+            print "{name}: {outcome}".format(
+                name=name, outcome=outcomes[name][0])
+            report['stages'].append(records.get(
+                name, {'stage': name, 'outcome': outcomes[name][0]}))
+    if report_file is not None:
+        write_report(report, report_file)
+    return outcomes
@@ -0,0 +1,297 @@
+"""Tests of ftp_upload.py against an ftp server running in this process.
+
+Needs pyftpdlib (the tests are skipped without it):
+
+    python -m unittest test_ftp_upload
+"""
+import gzip
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+import ftp_upload
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.filesystems import AbstractedFS
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:  # pyftpdlib is only needed for these tests
+    FTPHandler = None
+
+REMOTE_DIR = 'incoming'
+
+logging.getLogger('pyftpdlib').setLevel(logging.CRITICAL)
+
+
+if FTPHandler is not None:
+    class ThreadSafeFS(AbstractedFS):
+        """A file system that does not change the process's directory."""
+
+        def chdir(self, path):
+            if not os.path.isdir(path):
+                raise OSError(2, 'No such directory')
+            self._cwd = self.fs2ftp(path)
+
+    class RecordingHandler(FTPHandler):
+        """Records RESTs, fails the first fail_listings MLSDs and
+        fail_stors STORs and, with a gate, holds the first STORs until
+        that many are waiting at once."""
+
+        abstracted_fs = ThreadSafeFS
+        fail_listings = 0
+        fail_stors = 0
+        rests = []
+        gate = 0
+        waiting = []
+        most_waiting = 0
+
+        def ftp_REST(self, line):
+            self.rests.append(int(line))
+            return FTPHandler.ftp_REST(self, line)
+
+        def ftp_MLSD(self, path):
+            cls = self.__class__
+            if cls.fail_listings:
+                cls.fail_listings -= 1
+                self.respond('425 Simulated failure.')
+                return
+            return FTPHandler.ftp_MLSD(self, path)
+
+        def ftp_STOR(self, file, mode='w'):
+            cls = self.__class__
+            if cls.fail_stors:
+                cls.fail_stors -= 1
+                self.respond('451 Simulated failure.')
+                return
+            if not cls.gate:
+                return FTPHandler.ftp_STOR(self, file, mode)
+            cls.waiting.append(lambda: FTPHandler.ftp_STOR(self, file, mode))
+            cls.most_waiting = max(cls.most_waiting, len(cls.waiting))
+            if len(cls.waiting) == cls.gate:
+                self._open_gate()
+            elif len(cls.waiting) == 1:
+                # Fail rather than hang if the others never come.
+                self.ioloop.call_later(5, self._open_gate)
+
+        def _open_gate(self):
+            cls = self.__class__
+            cls.gate = 0
+            waiting, cls.waiting = cls.waiting, []
+            for stor in waiting:
+                stor()
+
+
+class RecordingTime(object):
+    """Stands in for the time module in ftp_upload, noting every sleep."""
+
+    def __init__(self):
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+def gzipped(data):
+    """Return data compressed with gzip, as in a .txt.gz file."""
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as outfile:
+        outfile.write(data)
+    return buf.getvalue()
+
+
+def free_port():
+    """Return a local port that nothing is listening on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@unittest.skipIf(FTPHandler is None, 'pyftpdlib is not installed')
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, 'server')
+        self.remote = os.path.join(self.root, REMOTE_DIR)
+        self.local = os.path.join(self.dir, 'local')
+        os.makedirs(self.remote)
+        os.makedirs(self.local)
+        self.manifest = os.path.join(self.dir, 'upload_manifest.json')
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(self.root, perm='elradfmwMT')
+        # pyftpdlib's handlers are classic classes, so no type() here.
+        class Handler(RecordingHandler):
+            pass
+        Handler.authorizer = authorizer
+        Handler.rests = []
+        Handler.waiting = []
+        self.handler = Handler
+        self.server = FTPServer(('127.0.0.1', 0), self.handler)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.time = ftp_upload.time
+        ftp_upload.time = RecordingTime()
+
+    def tearDown(self):
+        ftp_upload.time = self.time
+        self.server.close_all()
+        self.thread.join(5)
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data, remote=False):
+        """Write a local (or, with remote, a server) file."""
+        path = os.path.join(self.remote if remote else self.local, name)
+        with open(path, 'wb') as outfile:
+            outfile.write(data)
+        return path
+
+    def read_remote(self, name):
+        with open(os.path.join(self.remote, name), 'rb') as infile:
+            return infile.read()
+
+    def upload(self, file_list, **kwargs):
+        kwargs.setdefault('retry_delay', 0.5)
+        return ftp_upload.upload_files(
+            file_list, manifest_file=self.manifest, host='127.0.0.1',
+            port=self.port, remote_dir=REMOTE_DIR, **kwargs)
+
+    def test_fresh_upload(self):
+        data = gzipped(os.urandom(200000))
+        binary = self.write('2401001_20160121.txt.gz', data)
+        text = self.write('2401005_20160121.txt', 'a,b\n1,2\n')
+        results = self.upload([binary, text])
+        self.assertEqual(results, {binary: 'uploaded', text: 'uploaded'})
+        self.assertEqual(self.read_remote('2401001_20160121.txt.gz'), data)
+        self.assertEqual(self.read_remote('2401005_20160121.txt'),
+                         'a,b\n1,2\n')
+        manifest = ftp_upload.load_manifest(self.manifest)
+        self.assertEqual(manifest['2401001_20160121.txt.gz']['hash'],
+                         ftp_upload.file_hash(binary))
+        # Nothing changed, so nothing is sent the second time.
+        self.assertEqual(self.upload([binary, text]),
+                         {binary: 'unchanged', text: 'unchanged'})
+
+    def test_new_banner_time_is_unchanged(self):
+        # A SMAP file made again from the same data only differs in the
+        # time in its banner row (see smap_writer.banner).
+        rows = 'ID,Yr\r\n2401001,2016-01-21 00:00:00,1.0\r\n'
+        text = self.write(
+            '2401001_20160121.txt',
+            '"Station 1","Thu, 21 Jan 2016 10:00 GMT"\r\n' + rows)
+        self.assertEqual(self.upload([text]), {text: 'uploaded'})
+        self.write('2401001_20160121.txt',
+                   '"Station 1","Thu, 21 Jan 2016 11:00 GMT"\r\n' + rows)
+        self.assertEqual(self.upload([text]), {text: 'unchanged'})
+        self.write('2401001_20160121.txt',
+                   '"Station 1","Thu, 21 Jan 2016 12:00 GMT"\r\n' +
+                   rows.replace('1.0', '2.0'))
+        self.assertEqual(self.upload([text]),
+                         {text: 'uploaded as 2401001_20160121_v2.txt'})
+
+    def test_resume(self):
+        data = gzipped(os.urandom(300000))
+        binary = self.write('2401001_20160121.txt.gz', data)
+        self.write('2401001_20160121.txt.gz', data[:120000], remote=True)
+        results = self.upload([binary])
+        self.assertEqual(results, {binary: 'resumed'})
+        self.assertEqual(self.handler.rests, [120000])
+        self.assertEqual(self.read_remote('2401001_20160121.txt.gz'), data)
+
+    def test_missing_version_starts_again(self):
+        # Sent as _v2, which is gone from the server; the original, with
+        # other data, is still there. Its size is no offset for the _v2.
+        data = gzipped(os.urandom(200000))
+        binary = self.write('2401001_20160121.txt.gz', data)
+        self.write('2401001_20160121.txt.gz', gzipped('old'), remote=True)
+        ftp_upload.save_manifest({'2401001_20160121.txt.gz': {
+            'hash': ftp_upload.file_hash(binary), 'size': len(data),
+            'remote': '2401001_20160121_v2.txt.gz'}}, self.manifest)
+        results = self.upload([binary])
+        self.assertEqual(
+            results, {binary: 'uploaded as 2401001_20160121_v2.txt.gz'})
+        self.assertEqual(self.handler.rests, [])
+        self.assertEqual(self.read_remote('2401001_20160121_v2.txt.gz'), data)
+
+    def test_retry_with_backoff(self):
+        data = gzipped(os.urandom(100000))
+        binary = self.write('2401001_20160121.txt.gz', data)
+        self.handler.fail_stors = 2
+        results = self.upload([binary], retries=3)
+        self.assertEqual(results, {binary: 'uploaded'})
+        self.assertEqual(ftp_upload.time.sleeps, [0.5, 1.0])
+        self.assertEqual(self.read_remote('2401001_20160121.txt.gz'), data)
+
+    def test_gives_up_after_retries(self):
+        binary = self.write('2401001_20160121.txt.gz', gzipped('data'))
+        self.handler.fail_stors = 3
+        results = self.upload([binary], retries=2)
+        self.assertTrue(results[binary].startswith('failed'))
+        self.assertEqual(ftp_upload.time.sleeps, [0.5, 1.0])
+        self.assertNotIn('2401001_20160121.txt.gz',
+                         ftp_upload.load_manifest(self.manifest))
+
+    def test_retry_listing(self):
+        binary = self.write('2401001_20160121.txt.gz', gzipped('data'))
+        self.handler.fail_listings = 2
+        results = self.upload([binary], retries=2)
+        self.assertEqual(results, {binary: 'uploaded'})
+        self.assertEqual(ftp_upload.time.sleeps, [0.5, 1.0])
+
+    def test_retried_overwrite_starts_again(self):
+        # The old file is longer than the new one. A retry that resumed
+        # from its size would leave it as it was.
+        old = gzipped(os.urandom(200000))
+        new = gzipped(os.urandom(100000))
+        binary = self.write('2401001_20160121.txt.gz', old)
+        self.upload([binary])
+        self.write('2401001_20160121.txt.gz', new)
+        self.handler.fail_stors = 1
+        results = self.upload([binary], policy='overwrite')
+        self.assertEqual(results, {binary: 'overwritten'})
+        self.assertEqual(self.handler.rests, [])
+        self.assertEqual(self.read_remote('2401001_20160121.txt.gz'), new)
+
+    def test_connection_refused(self):
+        binary = self.write('2401001_20160121.txt.gz', gzipped('data'))
+        text = self.write('2401005_20160121.txt', 'a,b\n')
+        results = ftp_upload.upload_files(
+            [binary, text], manifest_file=self.manifest, host='127.0.0.1',
+            port=free_port(), remote_dir=REMOTE_DIR, retries=1,
+            retry_delay=0.5)
+        self.assertEqual(sorted(results), sorted([binary, text]))
+        self.assertTrue(all(
+            status.startswith('failed') for status in results.values()))
+        self.assertFalse(os.path.exists(self.manifest))
+
+    def test_pool_of_connections(self):
+        self.handler.gate = 3
+        files = dict(
+            (self.write('24010{0:02d}_20160121.txt.gz'.format(n),
+                        gzipped(os.urandom(32 * 1024))), n)
+            for n in range(6))
+        results = self.upload(sorted(files), connections=3)
+        self.assertEqual(set(results.values()), set(['uploaded']))
+        # Three files were being sent at the same time.
+        self.assertEqual(self.handler.most_waiting, 3)
+        for local_file in files:
+            with open(local_file, 'rb') as infile:
+                self.assertEqual(
+                    self.read_remote(os.path.basename(local_file)),
+                    infile.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
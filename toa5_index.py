@@ -0,0 +1,246 @@
+"""Find records in CSI (TOA5) datafiles by time without reading everything.
+
+A sparse index maps the timestamp of every `step`-th record to its byte
+offset in the file. It is kept in a small JSON file next to the datafile
+(<datafile>.idx) and extended, rather than rebuilt, when the file grows.
+With it we can jump straight to any time range:
+
+    index = update_index('CR216_SN22028_soil.dat')
+    for line in read_range('CR216_SN22028_soil.dat', index,
+                           '2016-03-01 00:00:00', '2016-03-08 00:00:00'):
+        ...
+
+The first and last records can be found without an index at all, by
+reading just after the header and just before the end of the file.
+
+Compressed datafiles (see compression.py) work too, but they can only be
+read from the start: finding the last record, or seeking to an index
+entry, decompresses everything before it.
+
+Timestamps may be given with or without the double quotes CSI puts around
+them. Files are assumed to be sorted by time; the index counts the records
+that are not (see update_index), and toa5_sort.py can put them in order.
+"""
+import json
+import os
+from bisect import bisect_left
+
+from compression import is_compressed, open_file
+from watermarks import header_hash
+
+# Records between index entries.
+INDEX_STEP = 1024
+
+# Bytes read from the end of a file when looking for its last record.
+TAIL_BLOCK = 4096
+
+
+def _quoted(timestamp):
+    """Return a timestamp with CSI double quotes around it."""
+    if timestamp.startswith('"'):
+        return timestamp
+    return '"' + timestamp + '"'
+
+
+def _data_start(in_file, header_lines):
+    """Return the offset of the first data line, leaving in_file there."""
+    in_file.seek(0)
+    for _ in range(header_lines):
+        in_file.readline()
+    return in_file.tell()
+
+
+def first_record(input_file, header_lines=4):
+    """Return the first data line of a file, or None if there is none."""
+    with open_file(input_file, 'rb') as in_file:
+        _data_start(in_file, header_lines)
+        line = in_file.readline()
+    return line.rstrip('\r\n') or None
+
+
+def last_record(input_file, header_lines=4):
+    """Return the last data line of a file, or None if there is none.
+
+    Only the end of the file is read, however long the file is (unless
+    it is compressed).
+    """
+    if is_compressed(input_file):
+        return _last_streamed_record(input_file, header_lines)
+    with open(input_file, 'rb') as in_file:
+        data_start = _data_start(in_file, header_lines)
+        in_file.seek(0, os.SEEK_END)
+        end = in_file.tell()
+        block = TAIL_BLOCK
+        while True:
+            start = max(data_start, end - block)
+            in_file.seek(start)
+            lines = in_file.read(end - start).rstrip('\r\n').split('\n')
+            # Unless we reached the header, the first line may be partial.
+            if len(lines) > 1 or start == data_start:
+                return lines[-1].rstrip('\r') or None
+            block *= 2
+
+
+def _last_streamed_record(input_file, header_lines):
+    """Return the last data line of a file that can only be read in order."""
+    with open_file(input_file, 'rb') as in_file:
+        _data_start(in_file, header_lines)
+        tail = ''
+        for block in iter(lambda: in_file.read(TAIL_BLOCK * 256), ''):
+            tail += block
+            # Keep only the last line (and whatever blank lines follow it).
+            start = tail.rstrip('\r\n').rfind('\n') + 1
+            tail = tail[start:]
+    return tail.rstrip('\r\n') or None
+
+
+def last_timestamp(input_file, header_lines=4):
+    """Return the timestamp of the last record, without its quotes."""
+    line = last_record(input_file, header_lines)
+    if line is None:
+        return None
+    return line.split(',')[0].strip('"')
+
+
+def load_index(input_file, index_file=None):
+    """Load the index of a datafile, or return None if it has none."""
+    index_file = index_file or input_file + '.idx'
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, 'r') as infile:
+        return json.load(infile)
+
+
+def update_index(input_file, index_file=None, header_lines=4,
+                 step=INDEX_STEP):
+    """Bring the index of a datafile up to date and return it.
+
+    Only the part of the file added since the index was last updated is
+    read. If the file shrank or its header changed the index is rebuilt.
+    The index is saved to index_file (<input_file>.idx by default).
+
+    index['unsorted'] is the number of records whose timestamp is not
+    later than every one before it (out of order, or repeated). While it
+    is 0 the file is sorted and has one record per timestamp. Otherwise
+    the records from index['sorted_from'] on are the sorted tail: in
+    order, and all later than index['sorted_after'], the latest timestamp
+    before them. So a reader that has dealt with the records before the
+    tail can go on from there as if the file were sorted.
+
+    If the file is the same size as when the index was saved, nothing is
+    read at all (a compressed file could only be read from the start).
+    """
+    index_file = index_file or input_file + '.idx'
+    index = load_index(input_file, index_file)
+    header = header_hash(input_file, header_lines)
+    size = os.path.getsize(input_file)
+    if index is None or index['header'] != header or \
+            index['step'] != step or 'sorted_from' not in index or \
+            'size' not in index or size < index['size']:
+        index = None
+    elif size == index['size']:
+        return index
+
+    with open_file(input_file, 'rb') as in_file:
+        data_start = _data_start(in_file, header_lines)
+        if index is None:
+            index = {
+                'header': header,
+                'header_lines': header_lines,
+                'step': step,
+                'data_start': data_start,
+                'end': data_start,
+                'count': 0,
+                'entries': [],
+                'last': None,
+                'latest': None,
+                'unsorted': 0,
+                'sorted_from': data_start,
+                'sorted_entry': 0,
+                'sorted_after': None,
+            }
+        in_file.seek(index['end'])
+        position = index['end']
+        for line in iter(in_file.readline, ''):
+            if not line.endswith('\n'):
+                break  # The logger is still writing this record.
+            timestamp = line.split(',', 1)[0]
+            if index['count'] % step == 0:
+                index['entries'].append([timestamp, position])
+            if index['count'] and timestamp <= index['latest']:
+                index['unsorted'] += 1
+                # The sorted tail starts again after this record.
+                index['sorted_from'] = position + len(line)
+                index['sorted_entry'] = len(index['entries'])
+                index['sorted_after'] = index['latest']
+            else:
+                index['latest'] = timestamp
+            index['count'] += 1
+            index['last'] = timestamp
+            position += len(line)
+        index['end'] = position
+        index['size'] = size
+
+    # Stages running at once may index the same file (the flux file).
+    tmp_file = '{0}.{1}.tmp'.format(index_file, os.getpid())
+    with open(tmp_file, 'w') as outfile:
+        json.dump(index, outfile)
+    os.rename(tmp_file, index_file)
+    return index
+
+
+def seek_offset(index, timestamp):
+    """Return an offset at or before the first record at or after timestamp.
+
+    This is a binary search of the index entries themselves: a one item
+    [timestamp] sorts just before every [timestamp, offset] entry. Only
+    the sorted tail of the file is searched (all of it, if it is sorted;
+    see update_index).
+    """
+    start = index['sorted_entry']
+    i = bisect_left(index['entries'], [_quoted(timestamp)], start) - 1
+    if i < start:
+        return index['sorted_from']
+    return index['entries'][i][1]
+
+
+def record_offset(input_file, index, timestamp):
+    """Return the offset of the first record at or after timestamp.
+
+    Only the sorted tail is looked at (see seek_offset). Returns
+    index['end'] if there is no such record.
+    """
+    timestamp = _quoted(timestamp)
+    position = seek_offset(index, timestamp)
+    with open_file(input_file, 'rb') as in_file:
+        in_file.seek(position)
+        while position < index['end']:
+            line = in_file.readline()
+            if line.split(',', 1)[0] >= timestamp:
+                break
+            position += len(line)
+    return position
+
+
+def read_range(input_file, index, start=None, end=None):
+    """Yield the data lines with start <= timestamp < end.
+
+    param: index - The index of input_file (see update_index).
+    param: start, end - CSI timestamps. None means no limit.
+
+    Reading starts at the nearest index entry before start and stops at
+    the first record at or after end.
+    """
+    start = start and _quoted(start)
+    end = end and _quoted(end)
+    with open_file(input_file, 'rb') as in_file:
+        if start is None:
+            in_file.seek(index['data_start'])
+        else:
+            in_file.seek(seek_offset(index, start))
+        for line in in_file:
+            timestamp = line.split(',', 1)[0]
+            if end is not None and timestamp >= end:
+                return
+            if start is None or timestamp >= start:
+                yield line
@@ -0,0 +1,157 @@
+"""Read CSI (TOA5) datafiles through a memory map.
+
+The file is mapped into memory instead of being read into Python strings,
+so the operating system shares its pages with the page cache and nothing
+has to be copied up front. The header is parsed once when the file is
+opened, and the data region can be used directly as a (read-only) buffer.
+Header lines are simply skipped, so there is never any need to rewrite a
+file to get rid of them.
+
+    with TOA5File('CR216_SN22028_soil.dat') as toa5:
+        for ts, rain in toa5.iter_columns(['"TIMESTAMP"', '"Rain_mm_Tot"']):
+            ...
+
+Only the requested columns are split out of each line: fields after the
+last one we need are never tokenized.
+
+A compressed file (see compression.py) cannot be mapped, so it is read as
+a stream instead, and it is all one chunk.
+"""
+import mmap
+import os
+
+from compression import is_compressed, open_file
+
+
+class TOA5File(object):
+    """A memory-mapped (or, if compressed, streamed) CSI datafile.
+
+    Attributes:
+        header - The header lines, each split into a list of fields.
+        names - The variable names (the second of four header lines, or
+            the only line of a one-line header).
+        data_start - Byte offset of the first data line.
+    """
+
+    def __init__(self, input_file, header_lines=4):
+        """Open and map input_file, and parse its header.
+
+        param: header_lines - 4 for CSI datafiles, 1 for the files written
+            by the downscaler and by merge_join.
+        """
+        self.input_file = input_file
+        self._file = open_file(input_file, 'rb')
+        self.streamed = is_compressed(input_file)
+        if self.streamed:
+            self._map = self._file  # Read with the same calls as a map.
+        elif os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = None  # Empty files cannot be mapped.
+        self.header = []
+        for _ in range(header_lines):
+            line = self._map.readline() if self._map else ''
+            self.header.append(line.rstrip('\r\n').split(','))
+        self.names = self.header[1 if header_lines == 4 else 0]
+        self.data_start = self._map.tell() if self._map else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap and close the file."""
+        if self._map is not None and not self.streamed:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    @property
+    def data(self):
+        """The data region of the file, as a read-only buffer (no copy).
+
+        A compressed file's data is decompressed into memory.
+        """
+        if self._map is None:
+            return buffer('')
+        if self.streamed:
+            self._map.seek(self.data_start)
+            return buffer(self._map.read())
+        return buffer(self._map, self.data_start)
+
+    def columns(self, variables=None):
+        """Return the column numbers of some variables, in file order.
+
+        param: variables - Variable names (with their double quotes). None
+            means every column.
+        """
+        if variables is None:
+            return range(len(self.names))
+        return sorted(self.names.index(var) for var in variables)
+
+    def chunks(self, n_chunks):
+        """Split the data region into at most n_chunks byte ranges.
+
+        Returns a list of (start, end) offsets of about the same size.
+        Every range starts at the start of a line and ends where the next
+        one starts, so each line is in exactly one range. A compressed file
+        can only be read from the start, so it is one range,
+        (data_start, None).
+        """
+        if self._map is None:
+            return []
+        if self.streamed:
+            return [(self.data_start, None)]
+        end = len(self._map)
+        size = end - self.data_start
+        bounds = [self.data_start]
+        for i in range(1, n_chunks):
+            start = self._map.find(
+                '\n', self.data_start + size * i // n_chunks - 1) + 1
+            if start <= 0:
+                break
+            if start > bounds[-1]:
+                bounds.append(start)
+        bounds.append(end)
+        return [(start, stop) for start, stop in zip(bounds, bounds[1:])
+                if stop > start]
+
+    def iter_lines(self, offset=None, end=None):
+        """Yield every data line (without its line ending).
+
+        param: offset - Start here instead of at the first data line. It
+            must be the start of a line.
+        param: end - Stop at the line that starts here (see chunks).
+        """
+        if self._map is None:
+            return
+        readline = self._map.readline
+        self._map.seek(self.data_start if offset is None else offset)
+        if end is None:
+            for line in iter(readline, ''):
+                yield line.rstrip('\r\n')
+            return
+        tell = self._map.tell
+        while tell() < end:
+            line = readline()
+            if not line:
+                return
+            yield line.rstrip('\r\n')
+
+    def iter_columns(self, variables=None, offset=None, end=None):
+        """Yield a list of the requested fields for every data line.
+
+        param: variables - Variable names (with their double quotes) to
+            return, in file order like `cut`. None returns every column.
+        param: offset, end - See iter_lines.
+        """
+        columns = self.columns(variables)
+        if not columns:
+            return
+        last = columns[-1]
+        for line in self.iter_lines(offset, end):
+            fields = line.split(',', last + 1)
+            yield [fields[c] for c in columns]
@@ -0,0 +1,249 @@
+"""Sort CSI (TOA5) records by time and drop repeated ones, in bounded memory.
+
+The joins and the downscaler expect one record per timestamp, in time
+order. After a logger's clock is reset, or when data is collected again,
+a download can append records that overlap or come before the ones
+already in the file. Here they are put back in order with an external
+merge sort:
+
+    1. Records are read into memory until they take up about
+       memory_budget bytes. That run is sorted and spilled to a temporary
+       file, and so on until the input is used up.
+    2. The runs are merged. Records with the same timestamp come out in
+       the order they had in the input, and only the first or the last
+       of them (keep='first' or 'last') is kept.
+
+An input that fits in the budget is sorted in memory, without spill
+files. Timestamps are compared as plain strings, which for the quoted CSI
+format is the same as comparing them in time.
+
+    python toa5_sort.py CR216_SN22028_soil.dat sorted.dat --keep last
+
+The budget is MEMORY_BUDGET by default (SMAP_SORT_MB megabytes, or 128
+MB), and spill files go in the system's temporary directory (TMPDIR)
+unless spill_dir is given.
+"""
+import argparse
+import heapq
+import marshal
+import os
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+from compression import compression_of, open_file
+from merge_join import read_table
+from toa5_index import update_index
+
+MEMORY_BUDGET = int(os.environ.get('SMAP_SORT_MB') or 128) * 2**20
+
+# Which of the records with the same timestamp is kept.
+KEEP_POLICIES = ('first', 'last')
+
+# Most runs merged at once. More runs are first merged in batches.
+MERGE_FAN_IN = 64
+
+
+def line_key(line):
+    """Return the timestamp of a data line."""
+    return line.split(',', 1)[0]
+
+
+def _record_size(record):
+    """Roughly how many bytes a record takes up in memory."""
+    if isinstance(record, basestring):
+        return len(record) + 100
+    return sum(map(len, record)) + 60 * len(record) + 100
+
+
+def _spill(run, spill_dir):
+    """Write a run of records to a temporary file. Returns its name."""
+    handle, name = tempfile.mkstemp(prefix='toa5_sort_', dir=spill_dir)
+    with os.fdopen(handle, 'wb') as out_file:
+        dump = marshal.dump
+        for record in run:
+            dump(record, out_file)
+    return name
+
+
+def _read_run(name):
+    """Yield the records of a spill file."""
+    with open(name, 'rb') as in_file:
+        load = marshal.load
+        while True:
+            try:
+                yield load(in_file)
+            except EOFError:
+                return
+
+
+def _keyed(records, key, number):
+    """Yield (key, run number, record) so that equal keys keep run order."""
+    for record in records:
+        yield key(record), number, record
+
+
+def _merge(runs, key):
+    """Merge sorted runs; records with equal keys keep the order of runs."""
+    for _, _, record in heapq.merge(*[
+            _keyed(run, key, number) for number, run in enumerate(runs)]):
+        yield record
+
+
+def _runs(records, key, memory_budget, spill_dir, stats):
+    """Split records into sorted runs.
+
+    Returns (run, spill files): the last run is kept in memory, the ones
+    before it were spilled.
+    """
+    spilled = []
+    run = []
+    size = 0
+    last = None
+    for record in records:
+        this_key = key(record)
+        if last is not None and this_key <= last:
+            stats['unsorted'] += 1
+        last = this_key
+        stats['records'] += 1
+        run.append(record)
+        size += _record_size(record)
+        if size >= memory_budget:
+            run.sort(key=key)
+            spilled.append(_spill(run, spill_dir))
+            run = []
+            size = 0
+    run.sort(key=key)
+    return run, spilled
+
+
+def sorted_records(records, key=itemgetter(0), keep='last',
+                   memory_budget=None, spill_dir=None, stats=None):
+    """Yield records sorted by key, with only one record per key.
+
+    param: records - Data lines, or rows of fields (marshal must be able
+        to write them to the spill files).
+    param: key - Returns the timestamp of a record. By default the first
+        field of a row; use line_key for data lines.
+    param: keep - 'first' or 'last': which record to keep when several
+        have the same timestamp, in the order they were read.
+    param: memory_budget - Bytes of records to hold in memory before
+        spilling a run to disk (MEMORY_BUDGET by default).
+    param: spill_dir - Where to write the spill files.
+    param: stats - A dict that is filled in with the number of records
+        read, how many were not later than the one before them
+        (unsorted), how many repeated timestamps were dropped
+        (duplicates) and the number of spill files (runs).
+    """
+    if keep not in KEEP_POLICIES:
+        raise ValueError("Unknown keep policy: {0}".format(keep))
+    if stats is None:
+        stats = {}
+    stats.update(records=0, unsorted=0, duplicates=0, runs=0)
+    run, spilled = _runs(
+        records, key, memory_budget or MEMORY_BUDGET, spill_dir, stats)
+    stats['runs'] = len(spilled)
+    try:
+        while len(spilled) >= MERGE_FAN_IN:
+            batch = spilled[:MERGE_FAN_IN]
+            merged = _spill(_merge(map(_read_run, batch), key), spill_dir)
+            for name in batch:
+                os.remove(name)
+            # The batch holds the earliest records, so it stays first.
+            spilled = [merged] + spilled[MERGE_FAN_IN:]
+        merged = _merge(map(_read_run, spilled) + [run], key)
+        for _, group in groupby(merged, key=key):
+            record = next(group)
+            for record_after in group:
+                stats['duplicates'] += 1
+                if keep == 'last':
+                    record = record_after
+            yield record
+    finally:
+        for name in spilled:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def read_sorted_table(input_file, variables=None, header_lines=4,
+                      keep='last', memory_budget=None, stats=None):
+    """Read a table like merge_join.read_table, in order and without repeats.
+
+    The file's index (see toa5_index.py) says whether it has any records
+    out of order or repeated. If not, the rows are read as they are;
+    otherwise they go through sorted_records. stats is filled in as by
+    sorted_records.
+    """
+    header, rows = read_table(input_file, variables, header_lines)
+    index = update_index(input_file, header_lines=header_lines)
+    if not index['unsorted']:
+        if stats is not None:
+            stats.update(records=index['count'], unsorted=0, duplicates=0,
+                         runs=0)
+        return header, rows
+    return header, sorted_records(
+        rows, keep=keep, memory_budget=memory_budget, stats=stats)
+
+
+def sort_datafile(input_file, output_file=None, header_lines=4, keep='last',
+                  memory_budget=None, spill_dir=None):
+    """Write a datafile's records in time order, one per timestamp.
+
+    param: output_file - Where to write them; by default input_file is
+        replaced (once the sorted copy is complete). Either may be
+        compressed (see compression.py).
+    param: spill_dir - Where to write the spill files; by default next to
+        output_file.
+
+    The header lines are copied as they are. Returns the stats of
+    sorted_records.
+    """
+    output_file = output_file or input_file
+    if spill_dir is None:
+        spill_dir = os.path.dirname(os.path.abspath(output_file))
+    stats = {}
+    tmp_file = output_file + '.tmp'
+    with open_file(input_file, 'rb') as in_file, open_file(
+            tmp_file, 'wb', compression_of(output_file)) as out_file:
+        header = [in_file.readline() for _ in range(header_lines)]
+        out_file.writelines(header)
+        line_end = '\r\n' if header and header[0].endswith('\r\n') else '\n'
+        # The logger may still be writing the last record.
+        lines = (
+            line if line.endswith('\n') else line + line_end
+            for line in in_file if line.strip())
+        out_file.writelines(sorted_records(
+            lines, line_key, keep, memory_budget, spill_dir, stats))
+    os.rename(tmp_file, output_file)
+    return stats
+
+
+def main():
+    """Sort a datafile from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input_file', help='The datafile to sort.')
+    parser.add_argument(
+        'output_file', nargs='?',
+        help='Where to write the sorted records (default: replace '
+             'input_file).')
+    parser.add_argument(
+        '--keep', choices=KEEP_POLICIES, default='last',
+        help='Which of several records with the same timestamp to keep '
+             '(default: last).')
+    parser.add_argument(
+        '--memory-mb', type=float, default=MEMORY_BUDGET / 2.0**20,
+        help='Memory for records before they are spilled to disk '
+             '(default: SMAP_SORT_MB or 128).')
+    parser.add_argument(
+        '--header-lines', type=int, default=4,
+        help='Header lines to copy (default: 4).')
+    args = parser.parse_args()
+    stats = sort_datafile(
+        args.input_file, args.output_file, args.header_lines, args.keep,
+        int(args.memory_mb * 2**20))
+    print "{records} records, {unsorted} out of order or repeated, " \
+        "{duplicates} duplicates dropped, {runs} spill files".format(**stats)
+
+
+if __name__ == '__main__':
+    main()
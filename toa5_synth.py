@@ -0,0 +1,222 @@
+"""Make synthetic CSI (TOA5) datafiles that look like the Mpala loggers'.
+
+For benchmarks (see benchmarks.py) and for trying the pipeline without
+the real data. The files have the 4-line CSI header, quoted timestamps,
+a RECORD column, "NAN" for failed readings and a few missing records, and
+the same columns the pipeline reads from the real files:
+
+    CR3000_SN9945_Table1.dat - tower soil moisture (VW*, PA*, Tsoil*)
+    CR5000_SN2446_upper.dat - tower rainfall
+    CR3000_SN4709_flux.dat - air temperature
+    CR216_SN22028_soil.dat, ... - CR216 rainfall, soil moisture and temp
+
+    python toa5_synth.py TowerData --years 2 --stations 4
+
+writes them into TowerData (with an empty TowerData/SMAP to run
+process_smap_data_for_NASA.py from).
+
+Values follow slow random walks within realistic ranges. So that large
+files can be made quickly, every column's walk is computed for a cycle
+of POOL_ROWS records and then repeated; only the timestamp and RECORD
+change from row to row.
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+# Records in one cycle of generated values. It is prime, so the cycle
+# does not line up with hours or days.
+POOL_ROWS = 1009
+
+# Logger table interval, in minutes.
+INTERVAL = 10
+
+START = datetime(2016, 1, 1)
+
+SITES = ['Tree', 'Grass', 'Riparian', 'Open']
+DEPTHS = ['005', '010', '020', '030', '100']
+TSOIL_SITES = ['Tree', 'Grass', 'Open']
+
+# The CR216 loggers. We should get CR216_SN22027_soil.dat someday. Extra
+# stations are numbered on from the last one.
+CR216_SERIALS = [22028, 22029, 22030, 22031]
+
+# Variable -> (low, high, step of the random walk). Rainfall is handled
+# separately (see _rain).
+RANGES = {
+    'VW': (0.05, 0.45, 0.002),
+    'PA': (18.0, 30.0, 0.1),
+    'Tsoil': (15.0, 35.0, 0.1),
+    'Temp': (15.0, 35.0, 0.1),
+    'Batt': (12.0, 13.8, 0.01),
+    't_hmp': (12.0, 32.0, 0.2),
+}
+
+
+def tower_columns():
+    """Return the variables of the tower soil moisture table."""
+    columns = []
+    for var in ['VW{depth}cm{site}_v0_Avg', 'PA{depth}cm{site}_Avg']:
+        for site in SITES:
+            columns.extend(
+                var.format(depth=depth, site=site) for depth in DEPTHS)
+    for site in TSOIL_SITES:
+        columns.extend(
+            ['Tsoil10cm' + site + '_Avg', 'Tsoil20cm' + site + '_Avg'])
+    return columns + ['BattV_Min']
+
+
+UPPER_COLUMNS = ['rainfall_Tot', 'BattV_Min']
+FLUX_COLUMNS = ['t_hmp_Avg', 'BattV_Min']
+CR216_COLUMNS = [
+    'BattV_Min', 'Rain_mm_Tot', 'VW_20cm_Avg', 'VW_05cm_Avg',
+    'Temp_20cm_Avg', 'Temp_05cm_Avg']
+
+
+def _walk(rng, low, high, step, digits):
+    """Return POOL_ROWS values of a random walk between low and high."""
+    value = rng.uniform(low, high)
+    values = []
+    for _ in range(POOL_ROWS):
+        value = min(high, max(low, value + rng.gauss(0, step)))
+        values.append(repr(round(value, digits)))
+    return values
+
+
+def _rain(rng):
+    """Return POOL_ROWS rainfall totals: mostly 0, with a few showers."""
+    values = []
+    shower = 0
+    for _ in range(POOL_ROWS):
+        if shower == 0 and rng.random() < 0.01:
+            shower = rng.randint(1, 12)
+        if shower:
+            shower -= 1
+            values.append(repr(round(rng.expovariate(2.0), 1)))
+        else:
+            values.append('0')
+    return values
+
+
+def _pool(columns, rng, nan_fraction):
+    """Return POOL_ROWS comma-joined rows of values for columns."""
+    series = []
+    for column in columns:
+        if column.startswith('Rain') or column.startswith('rain'):
+            values = _rain(rng)
+        else:
+            key = [k for k in RANGES if column.startswith(k)][0]
+            low, high, step = RANGES[key]
+            values = _walk(rng, low, high, step, 3 if key == 'VW' else 2)
+        series.append([
+            '"NAN"' if rng.random() < nan_fraction else value
+            for value in values])
+    return [','.join(row) for row in zip(*series)]
+
+
+def write_toa5(output_file, columns, years=1, start=START, interval=INTERVAL,
+               nan_fraction=0.01, gap_fraction=0.001, logger='CR3000',
+               serial='9945', table='Table1', seed=0):
+    """Write a synthetic CSI datafile.
+
+    param: columns - Variable names (without quotes), after TIMESTAMP and
+        RECORD.
+    param: years - Length of the record, in (365 day) years.
+    param: interval - Minutes between records.
+    param: nan_fraction - Share of values that are "NAN".
+    param: gap_fraction - Share of records that are missing.
+
+    Returns the number of records written.
+    """
+    rng = random.Random(seed)
+    pool = _pool(columns, rng, nan_fraction)
+    n_records = int(years * 365 * 24 * 60 / interval)
+    step = timedelta(minutes=interval)
+    written = 0
+    with open(output_file, 'wb') as out_file:
+        out_file.write(','.join([
+            '"TOA5"', '"{0}_SN{1}"'.format(logger, serial), '"' + logger + '"',
+            '"' + serial + '"', '"{0}.Std.27"'.format(logger),
+            '"CPU:smap.CR{0}"'.format(logger[2:]), '"12345"',
+            '"' + table + '"']) + '\n')
+        out_file.write(','.join(
+            '"' + name + '"' for name in ['TIMESTAMP', 'RECORD'] + columns
+        ) + '\n')
+        out_file.write(','.join(
+            ['"TS"', '"RN"'] + ['""'] * len(columns)) + '\n')
+        out_file.write(','.join(
+            ['""', '""'] + ['"Avg"'] * len(columns)) + '\n')
+        timestamp = start
+        lines = []
+        for record in xrange(n_records):
+            timestamp += step
+            if rng.random() < gap_fraction:
+                continue
+            lines.append('"{0}",{1},{2}\n'.format(
+                timestamp, record, pool[record % POOL_ROWS]))
+            written += 1
+            if len(lines) == 10000:
+                out_file.writelines(lines)
+                lines = []
+        out_file.writelines(lines)
+    return written
+
+
+def cr216_file(station):
+    """Return the datafile name of the station-th CR216 logger (from 0)."""
+    serial = CR216_SERIALS[0] + station
+    return 'CR216_SN{0}_soil.dat'.format(serial)
+
+
+def make_tower_data(data_dir, years=1, stations=4, start=START, seed=0):
+    """Write a full set of synthetic logger files into data_dir.
+
+    param: stations - Number of CR216 loggers (the first four are the ones
+        process_smap_data_for_NASA.py reads).
+
+    Also makes data_dir/SMAP, where the pipeline is run. Returns the
+    names of the files written.
+    """
+    smap_dir = os.path.join(data_dir, 'SMAP')
+    if not os.path.isdir(smap_dir):
+        os.makedirs(smap_dir)
+    files = [
+        ('CR3000_SN9945_Table1.dat', tower_columns(), 'CR3000', '9945',
+         'Table1'),
+        ('CR5000_SN2446_upper.dat', UPPER_COLUMNS, 'CR5000', '2446',
+         'upper'),
+        ('CR3000_SN4709_flux.dat', FLUX_COLUMNS, 'CR3000', '4709', 'flux'),
+    ]
+    for station in range(stations):
+        name = cr216_file(station)
+        files.append((name, CR216_COLUMNS, 'CR216', name[8:13], 'soil'))
+    written = []
+    for i, (name, columns, logger, serial, table) in enumerate(files):
+        write_toa5(
+            os.path.join(data_dir, name), columns, years=years, start=start,
+            logger=logger, serial=serial, table=table, seed=seed + i)
+        written.append(name)
+    return written
+
+
+def main():
+    """Write synthetic logger files from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('data_dir', help='Where to write the files.')
+    parser.add_argument(
+        '--years', type=float, default=1,
+        help='Length of the record in years (default: 1).')
+    parser.add_argument(
+        '--stations', type=int, default=4,
+        help='Number of CR216 loggers (default: 4).')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='Random seed (default: 0).')
+    args = parser.parse_args()
+    for name in make_tower_data(
+            args.data_dir, args.years, args.stations, seed=args.seed):
+        print name
+
+
+if __name__ == '__main__':
+    main()
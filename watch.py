@@ -0,0 +1,232 @@
+"""Keep the SMAP files up to date as the loggers write, instead of weekly.
+
+Run from the SMAP directory, like the pipeline, it keeps going:
+
+    python watch.py --cadence 60 --poll 60
+
+and watches the logger files in TowerData. When one of them grows, the
+stages that downscale it are run (see process_smap_data_for_NASA.py):
+only the records appended since the last time are read. For the tower
+they are joined and appended to the tenMinuteTable (see join_tower), and
+for every logger the hours they fall in are merged into its
+sixtyMinuteTable file (see watermarks.py and
+downscalers.downscale_incremental). Only the last hour of each file is
+read again, to be finished. So the work is done a little at a time, as
+the data comes in, rather than all at once on Sunday night.
+
+Every cadence minutes, if any logger has grown since the last time, the
+rest of the pipeline is run: the air temperature joins (the flux file is
+read through the column cache, see column_cache.py), the SMAP files and
+the upload. The stages that are up to date are skipped as usual, and a
+SMAP file whose data has not changed is not sent again. The cleanup
+stage is never run.
+
+A SMAP file holds the whole history and is named by the date of its last
+record, so most runs change files already on the server. The watcher
+therefore replaces them (--upload-policy overwrite) rather than sending
+each one again as name_vN every cadence, as the pipeline's default
+'version' policy would. Use 'version' for backfills and reprocessing.
+
+The watermarks are kept in memory between runs and saved after each one,
+so the pipeline can be run by hand (or the watcher restarted) at any time.
+
+Changes are noticed with inotify if pyinotify is installed; otherwise
+the logger files are looked at (size and modification time) every poll
+seconds. A logger file replaced by its compressed archive is not noticed
+until the watcher is restarted.
+"""
+import argparse
+import os
+import sys
+import time
+
+try:
+    import pyinotify
+except ImportError:  # Without it the logger files are polled
+    pyinotify = None
+
+import process_smap_data_for_NASA as pipeline
+from compression import COMPRESSIONS
+from ftp_upload import POLICIES
+from profiling import REPORT_FILE
+from stages import run_stages
+from toa5_sort import KEEP_POLICIES
+from watermarks import load_watermarks
+
+# Minutes between making and sending the SMAP files.
+CADENCE_MINUTES = 60
+
+# Seconds between looks at the logger files (without inotify, or at most
+# between wake ups with it).
+POLL_SECONDS = 60
+
+
+def logger_files():
+    """Return the logger files the pipeline reads."""
+    return [pipeline.soil_moisture_file, pipeline.upper_file,
+            pipeline.flux_data_file] + [
+        pipeline.find_file(pipeline.data_dir + '/' + soil_file)
+        for soil_file in sorted(pipeline.CR216_files.keys())]
+
+
+def snapshot(files):
+    """Return {file: (size, modification time)}; None for missing files."""
+    state = {}
+    for name in files:
+        try:
+            stat = os.stat(name)
+        except OSError:
+            state[name] = None
+        else:
+            state[name] = (stat.st_size, stat.st_mtime)
+    return state
+
+
+def changed_files(before, after):
+    """Return the files whose size or modification time has changed."""
+    return sorted(
+        name for name in after if after[name] != before.get(name))
+
+
+def new_notifier(directory):
+    """Return a pyinotify notifier for the files written in directory.
+
+    Returns None if pyinotify is not installed.
+    """
+    if pyinotify is None:
+        return None
+    watch_manager = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(
+        watch_manager, default_proc_fun=lambda event: None)
+    watch_manager.add_watch(
+        directory,
+        pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE |
+        pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE)
+    return notifier
+
+
+def wait(notifier, seconds):
+    """Wait for a file to be written (with a notifier), or seconds."""
+    if notifier is None:
+        time.sleep(seconds)
+    elif notifier.check_events(timeout=seconds * 1000):
+        notifier.read_events()
+        notifier.process_events()
+
+
+def downscale_stages(stages):
+    """Return the names of the downscale stages of the pipeline."""
+    return [
+        this_stage['name'] for this_stage in stages
+        if this_stage['name'].startswith('downscale')]
+
+
+def all_but_cleanup(stages):
+    """Return the names of every stage but cleanup."""
+    return [
+        this_stage['name'] for this_stage in stages
+        if this_stage['name'] != 'cleanup']
+
+
+def run(watermarks, targets, workers=None, policy='overwrite', keep='last',
+        compression=None, report_file=None):
+    """Bring some stages of the pipeline up to date.
+
+    param: targets - Picks the names of the stages to run from the list
+        of stages (e.g. downscale_stages).
+
+    The watermarks are updated and saved. Returns False if a stage failed.
+    """
+    stages = pipeline.pipeline(watermarks, policy, keep, compression)
+    outcomes = run_stages(
+        stages, workers=workers, targets=targets(stages),
+        report_file=report_file)
+    return pipeline.keep_watermarks(watermarks, outcomes)
+
+
+def watch(cadence=CADENCE_MINUTES, poll=POLL_SECONDS, workers=None,
+          policy='overwrite', keep='last', compression=None):
+    """Downscale the logger files as they grow, and send the SMAP files
+    every cadence minutes. Runs until it is interrupted.
+
+    param: cadence - Minutes between making and sending the SMAP files.
+    param: poll - Seconds between looks at the logger files.
+    param: workers, policy, keep, compression - As for the pipeline
+        (see process_smap_data_for_NASA.py).
+
+    The SMAP files are made as soon as it starts, and a failed stage is
+    tried again the next time its logger grows.
+    """
+    options = dict(
+        workers=workers, policy=policy, keep=keep, compression=compression)
+    watermarks = load_watermarks()
+    notifier = new_notifier(pipeline.data_dir)
+    files = logger_files()
+    seen = snapshot(files)
+    pending = True
+    last_sent = None
+    print "Watching {0} ({1}).".format(
+        pipeline.data_dir, 'inotify' if notifier else 'polling')
+    try:
+        while True:
+            if pending and (last_sent is None or
+                            time.time() - last_sent >= cadence * 60):
+                last_sent = time.time()
+                pending = False
+                run(watermarks, all_but_cleanup, report_file=REPORT_FILE,
+                    **options)
+            wait(notifier, poll)
+            now = snapshot(files)
+            grown = changed_files(seen, now)
+            seen = now
+            if grown:
+                print "{0}: {1} changed.".format(
+                    time.strftime('%Y-%m-%d %H:%M:%S'), ', '.join(
+                        os.path.basename(name) for name in grown))
+                run(watermarks, downscale_stages, **options)
+                pending = True
+    finally:
+        if notifier is not None:
+            notifier.stop()
+
+
+def main():
+    """Watch the logger files from the command line."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--cadence', type=float, default=CADENCE_MINUTES,
+        help='Minutes between making and sending the SMAP files '
+             '(default: 60).')
+    parser.add_argument(
+        '--poll', type=float, default=POLL_SECONDS,
+        help='Seconds between looks at the logger files (default: 60).')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of stages to run at once (default: SMAP_WORKERS '
+             'or the number of CPUs).')
+    parser.add_argument(
+        '--upload-policy', choices=POLICIES, default='overwrite',
+        help='What to do with files that changed since they were last '
+             'sent (default: replace them on the server).')
+    parser.add_argument(
+        '--duplicates', choices=KEEP_POLICIES, default='last',
+        help='Which of several logger records with the same timestamp to '
+             'use (default: the last one appended).')
+    parser.add_argument(
+        '--compress', choices=COMPRESSIONS, default=None,
+        help='Write the SMAP files compressed (default: plain text).')
+    args = parser.parse_args()
+    if args.cadence <= 0 or args.poll <= 0:
+        parser.error("--cadence and --poll must be more than 0")
+    try:
+        watch(args.cadence, args.poll, args.workers, args.upload_policy,
+              args.duplicates, args.compress)
+    except KeyboardInterrupt:
+        print "Stopped."
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
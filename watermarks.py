@@ -0,0 +1,80 @@
+"""Remember how much of each logger file has already been processed.
+
+The datalogger files in TowerData only ever grow, so once a file has been
+downscaled we only need to look at the records appended since the last run.
+For every source file we keep a watermark with:
+
+    offset - byte offset of the first record that still has to be read
+    timestamp - the CSI timestamp of the record at offset
+    last_timestamp - the last CSI timestamp that was processed
+    header - a hash of the four CSI header lines
+    size - the size of the file when the watermark was taken
+
+plus whatever the consumer needs to merge new results into its output.
+Watermarks are kept as JSON in a single store file, by default
+watermarks.json next to the SMAP outputs.
+
+Offsets and sizes are of the uncompressed text, so a compressed file
+(see compression.py) works too, though resuming it means decompressing
+everything before the offset.
+
+If a file shrinks, its header changes, or the record at the stored offset
+is not the one we expect, the file has been rotated or replaced and has to
+be processed from the start.
+"""
+import hashlib
+import json
+import os
+
+from compression import is_compressed, open_file
+
+WATERMARK_FILE = 'watermarks.json'
+
+
+def header_hash(input_file, n_lines=4):
+    """Return a hash of the first n_lines of a datafile."""
+    digest = hashlib.sha1()
+    with open_file(input_file, 'rb') as in_file:
+        for _ in range(n_lines):
+            digest.update(in_file.readline())
+    return digest.hexdigest()
+
+
+def load_watermarks(store_file=WATERMARK_FILE):
+    """Load the watermark store, or return an empty one if there is none."""
+    if not os.path.exists(store_file):
+        return {}
+    with open(store_file, 'r') as infile:
+        return json.load(infile)
+
+
+def save_watermarks(marks, store_file=WATERMARK_FILE):
+    """Write the watermark store, replacing the old one atomically."""
+    tmp_file = store_file + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(marks, outfile, indent=1, sort_keys=True)
+    os.rename(tmp_file, store_file)
+
+
+def resume_offset(input_file, mark):
+    """Return the byte offset to resume reading input_file from.
+
+    param: input_file - The datafile we are about to read.
+    param: mark - The stored watermark for this file (or None).
+
+    Returns None when the file has to be processed from the start.
+    """
+    if not mark:
+        return None
+    # The uncompressed size of a compressed file is not known without
+    # reading it all, so for those the record at the offset has to do.
+    if not is_compressed(input_file) and \
+            os.path.getsize(input_file) < mark['size']:
+        return None
+    if header_hash(input_file) != mark['header']:
+        return None
+    with open_file(input_file, 'rb') as in_file:
+        in_file.seek(mark['offset'])
+        if in_file.readline().split(',')[0] != mark['timestamp']:
+            return None
+    return mark['offset']